@@ -1,21 +1,27 @@
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-from shapely.geometry import box
+import shapely
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
+from restricoes_espaciais import FeatureIndex, GridIndex
+from cache_camadas import DerivedLayerCache
 
 # --- 1. PARÂMETROS ---
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 data_dir = os.path.join(project_root, 'data')
 DATA_GPKG = os.path.join(data_dir, 'Data.gpkg')
+CACHE_DIR = os.path.join(data_dir, 'cache')
 
 # Camadas de Entrada do Geopackage
 MG_BOUNDARY_LAYER = 'limites_minas_gerais_sisema'
 UC_LAYER = 'unidades_conservacao_sisema' 
 ROADS_LAYER = 'rodovias_minas_gerais_sisema'
 
-# Camada de SAÍDA
+# Camadas de SAÍDA
 OUTPUT_LAYER_NAME = 'AEs'
+SCENARIOS_OUTPUT_LAYER_NAME = 'AEs_cenarios'
 
 # Padrões de CRS
 CRS_GEOGRAPHIC = 'EPSG:4674'
@@ -27,69 +33,297 @@ AE_WIDTH_KM = 20
 AE_HEIGHT_KM = 15
 BUFFER_DISTANCE_KM = 5
 MAX_ATTEMPTS = 30000
+BATCH_SIZE = 5000
+RANDOM_SEED = 42
+
+# Cenários independentes (análise de sensibilidade). Com NUM_SCENARIOS > 1 os
+# cenários são gerados em paralelo e salvos em SCENARIOS_OUTPUT_LAYER_NAME; o
+# script 02 gera as ADAs de cada cenário a partir dessa camada.
+NUM_SCENARIOS = 1
+NUM_WORKERS = os.cpu_count()
+
+# Amostragem direta na região viável de centros (em vez de sortear no retângulo envolvente de MG)
+USE_FEASIBLE_REGION = True
+# Limites da amostragem na região viável: pontos sorteados por lote e nº
+# máximo de pontos sorteados por centro pedido (regiões muito finas)
+MAX_SAMPLE_BATCH = 1_000_000
+MAX_OVERSAMPLING = 1000
+
+def sample_centers_in_bounds(rng, bounds, size):
+    """
+    Sorteia `size` centros uniformes dentro do retângulo `bounds`.
+    """
+    minx, miny, maxx, maxy = bounds
+    return rng.uniform(minx, maxx, size), rng.uniform(miny, maxy, size)
+
+def sample_centers_in_region(rng, region, size):
+    """
+    Sorteia `size` centros uniformes dentro de `region` (preparada),
+    descartando em lote os pontos do retângulo envolvente que caem fora dela.
+    Os lotes têm no máximo MAX_SAMPLE_BATCH pontos e o total sorteado fica
+    limitado a `size` * MAX_OVERSAMPLING, então uma região muito fina pode
+    devolver menos de `size` centros (nenhum, se a área é nula).
+    """
+    xs_parts, ys_parts, n = [np.empty(0)], [np.empty(0)], 0
+    if region.is_empty or region.area == 0:
+        return xs_parts[0], ys_parts[0]
+    fill_ratio = region.area / shapely.box(*region.bounds).area
+    budget = size * MAX_OVERSAMPLING
+    while n < size and budget > 0:
+        draw = min(int((size - n) / fill_ratio * 1.1) + 1, MAX_SAMPLE_BATCH, budget)
+        budget -= draw
+        xs, ys = sample_centers_in_bounds(rng, region.bounds, draw)
+        inside = shapely.contains_xy(region, xs, ys)
+        xs_parts.append(xs[inside]); ys_parts.append(ys[inside])
+        n += int(inside.sum())
+    return np.concatenate(xs_parts)[:size], np.concatenate(ys_parts)[:size]
+
+def build_rectangles(xs, ys, width_m, height_m):
+    """
+    Constrói os retângulos candidatos de uma só vez (shapely.box vetorizado).
+    """
+    return shapely.box(xs - width_m/2, ys - height_m/2, xs + width_m/2, ys + height_m/2)
+
+def covering_buffer(geoms, distance, quad_segs=8):
+    """
+    Buffer de cada geometria que contém o buffer exato. Os arcos são
+    aproximados por cordas inscritas de até 1,5 × (90° / quad_segs) (o GEOS
+    arredonda o nº de segmentos de cada arco), então a distância é aumentada
+    até essas cordas ficarem a pelo menos `distance` da geometria.
+    """
+    max_half_angle = 1.5 * np.pi / (4 * quad_segs)
+    return shapely.buffer(geoms, distance / np.cos(max_half_angle), quad_segs=quad_segs)
+
+def build_feasible_region(mg_geom, uc_index, roads_index, width_m, height_m, max_distance_m):
+    """
+    Região de centros que podem gerar um retângulo válido. É um superconjunto
+    exato das regras: o centro de um retângulo dentro de MG está a pelo menos
+    meia largura menor da borda; um retângulo a até `max_distance_m` de uma UC,
+    ou que cruza uma rodovia, tem o centro a no máximo meia diagonal delas.
+    Os candidatos continuam passando por filter_candidates.
+    Cada UC e cada rodovia é expandida separadamente e só então as áreas são
+    unidas: expandir a camada dissolvida (uma única multigeometria estadual)
+    é muito mais lento. Só roda sem cache.
+    """
+    half_min = min(width_m, height_m) / 2
+    half_diagonal = np.hypot(width_m, height_m) / 2
+
+    region = mg_geom.buffer(-half_min)
+    region = region.intersection(shapely.union_all(covering_buffer(uc_index.geometries, max_distance_m + half_diagonal)))
+    region = region.intersection(shapely.union_all(covering_buffer(roads_index.geometries, half_diagonal)))
+    return region
+
+def load_or_build_feasible_region(cache_key, *args):
+    """
+    Lê a região viável do cache em disco (WKB) ou a constrói e salva.
+    """
+    cache_path = os.path.join(CACHE_DIR, f'regiao_viavel_{cache_key}.wkb')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            print(f"Região viável lida do cache: {cache_path}")
+            return shapely.from_wkb(f.read())
+
+    print("Construindo região viável de centros...")
+    region = build_feasible_region(*args)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path, 'wb') as f:
+        f.write(shapely.to_wkb(region))
+    print(f"Região viável salva em cache: {cache_path}")
+    return region
+
+def filter_candidates(candidates, mg_geom, uc_index, roads_index, max_distance_m):
+    """
+    Aplica as regras espaciais de forma vetorizada e retorna a máscara
+    booleana dos candidatos aprovados. Cada predicado só é avaliado sobre
+    os candidatos que passaram nos anteriores, dos mais baratos aos mais caros.
+    O limite de MG deve estar preparado (shapely.prepare); UCs e rodovias
+    são consultadas feição a feição pelos índices espaciais.
+    """
+    mask = np.zeros(len(candidates), dtype=bool)
+    idx = np.flatnonzero(shapely.within(candidates, mg_geom))
+
+    idx = idx[~uc_index.within_union(candidates[idx])]
+    idx = idx[uc_index.dwithin_any(candidates[idx], max_distance_m)]
+    idx = idx[roads_index.intersects_any(candidates[idx])]
+
+    mask[idx] = True
+    return mask
+
+def generate_polygons(rng, context, verbose=True):
+    """
+    Gera até NUM_AE_TO_GENERATE retângulos válidos e não sobrepostos.
+    `context` reúne as geometrias e índices já carregados e preparados.
+    Retorna a lista de polígonos, o nº de tentativas e o nº de candidatos
+    aprovados pelas regras espaciais.
+    """
+    width_m, height_m = context['width_m'], context['height_m']
+    feasible_region = context['feasible_region']
+    generated_polygons = []
+    attempts = 0
+    n_passed = 0
+    accepted_index = GridIndex(cell_size=max(width_m, height_m))
+
+    while len(generated_polygons) < NUM_AE_TO_GENERATE and attempts < MAX_ATTEMPTS:
+        batch_size = min(BATCH_SIZE, MAX_ATTEMPTS - attempts)
+        if feasible_region is not None:
+            xs, ys = sample_centers_in_region(rng, feasible_region, batch_size)
+        else:
+            xs, ys = sample_centers_in_bounds(rng, context['mg_geom'].bounds, batch_size)
+        candidates = build_rectangles(xs, ys, width_m, height_m)
+        passed = filter_candidates(candidates, context['mg_geom'], context['uc_index'],
+                                   context['roads_index'], context['max_distance_m'])
+        n_passed += int(passed.sum())
+
+        # Apenas os sobreviventes passam pela verificação sequencial de sobreposição
+        for i in np.flatnonzero(passed):
+            candidate_rectangle = candidates[i]
+            if accepted_index.intersects_any(candidate_rectangle):
+                continue
+
+            accepted_index.insert(candidate_rectangle)
+            generated_polygons.append(candidate_rectangle)
+            if verbose:
+                print(f"AE {len(generated_polygons)}/{NUM_AE_TO_GENERATE} gerada. (Tentativa {attempts + i + 1})")
+            if len(generated_polygons) >= NUM_AE_TO_GENERATE:
+                break
+
+        attempts += batch_size
+
+    return generated_polygons, attempts, n_passed
+
+# Contexto de cada processo do pool, montado uma única vez por _init_worker
+_WORKER_CONTEXT = {}
+
+def _init_worker(mg_wkb, uc_wkb, roads_wkb, region_wkb, width_m, height_m, max_distance_m):
+    """
+    Inicializa um processo do pool a partir das geometrias já carregadas no
+    processo principal (em WKB), sem reler o GeoPackage.
+    """
+    mg_geom = shapely.from_wkb(mg_wkb)
+    shapely.prepare(mg_geom)
+    feasible_region = shapely.from_wkb(region_wkb) if region_wkb is not None else None
+    if feasible_region is not None:
+        shapely.prepare(feasible_region)
+    _WORKER_CONTEXT.update(
+        mg_geom=mg_geom,
+        uc_index=FeatureIndex(shapely.from_wkb(uc_wkb)),
+        roads_index=FeatureIndex(shapely.from_wkb(roads_wkb)),
+        feasible_region=feasible_region,
+        width_m=width_m, height_m=height_m, max_distance_m=max_distance_m,
+    )
+
+def _run_scenario(scenario_id, seed_sequence):
+    """Gera um cenário no processo do pool com sua própria semente."""
+    rng = np.random.default_rng(seed_sequence)
+    polygons, _, _ = generate_polygons(rng, _WORKER_CONTEXT, verbose=False)
+    return scenario_id, polygons
+
+def generate_scenarios(context, num_scenarios, num_workers):
+    """
+    Gera `num_scenarios` cenários independentes em um pool de processos.
+    As sementes derivam de RANDOM_SEED (SeedSequence.spawn), então cada
+    cenário é reprodutível independentemente da ordem de execução.
+    """
+    seeds = np.random.SeedSequence(RANDOM_SEED).spawn(num_scenarios)
+    region = context['feasible_region']
+    initargs = (
+        shapely.to_wkb(context['mg_geom']),
+        shapely.to_wkb(context['uc_index'].geometries),
+        shapely.to_wkb(context['roads_index'].geometries),
+        shapely.to_wkb(region) if region is not None else None,
+        context['width_m'], context['height_m'], context['max_distance_m'],
+    )
+    results = {}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=initargs) as pool:
+        for scenario_id, polygons in pool.map(_run_scenario, range(num_scenarios), seeds):
+            results[scenario_id] = polygons
+            print(f"Cenário {scenario_id + 1}/{num_scenarios}: {len(polygons)} AEs geradas.")
+    return results
 
 def main():
     """
     Função principal para gerar as Áreas de Estudo (AEs).
     """
     print("Iniciando Script 01: Geração de AEs")
-    np.random.seed(42)
     
     # --- 2. DADOS DE ENTRADA / GEOMETRIA ---
     print(f"Carregando dados de: {DATA_GPKG}")
 
+    # Camadas de base já reprojetadas/dissolvidas vêm do cache compartilhado
+    layer_cache = DerivedLayerCache(DATA_GPKG, CACHE_DIR)
+
     # Carregar limite de Minas Gerais
-    mg_boundary_gdf = gpd.read_file(DATA_GPKG, layer=MG_BOUNDARY_LAYER)
-    mg_boundary_projected_geom = mg_boundary_gdf.to_crs(CRS_PROJECTED).union_all()
+    mg_boundary_projected_geom = layer_cache.get(MG_BOUNDARY_LAYER, 'dissolve', CRS_PROJECTED).geometry.iloc[0]
     print("Limite de MG carregado.")
 
     print(f"Carregando UCs: '{UC_LAYER}'")
-    all_ucs = gpd.read_file(DATA_GPKG, layer=UC_LAYER)
-    ucs_unified_projected_geom = all_ucs.to_crs(CRS_PROJECTED).union_all()
+    all_ucs = layer_cache.get(UC_LAYER, 'project', CRS_PROJECTED)
+    uc_index = FeatureIndex.from_gdf(all_ucs)
     print(f"{len(all_ucs)} UCs carregadas.")
 
-    # Unificar Rodovias
-    gdf_roads = gpd.read_file(DATA_GPKG, layer=ROADS_LAYER)
-    roads_unified_projected_geom = gdf_roads.to_crs(CRS_PROJECTED).union_all()
+    # Indexar Rodovias
+    roads_index = FeatureIndex.from_gdf(layer_cache.get(ROADS_LAYER, 'project', CRS_PROJECTED))
     print("Rodovias carregadas.")
 
-    #3. GERANDO ÁREAS DE ESTUDO SEGUNDO REGRAS
-    print(f"\nGerando {NUM_AE_TO_GENERATE} retângulos...")
-
-    generated_polygons = []
-    minx, miny, maxx, maxy = mg_boundary_projected_geom.bounds
     width_m = AE_WIDTH_KM * 1000
     height_m = AE_HEIGHT_KM * 1000
     max_distance_m = BUFFER_DISTANCE_KM * 1000
-    attempts = 0
 
-    while len(generated_polygons) < NUM_AE_TO_GENERATE and attempts < MAX_ATTEMPTS:
-        attempts += 1
-        
-        rand_x = np.random.uniform(minx, maxx)
-        rand_y = np.random.uniform(miny, maxy)
-        
-        candidate_rectangle = box(rand_x - width_m/2, rand_y - height_m/2, 
-                                  rand_x + width_m/2, rand_y + height_m/2)
-
-        if not candidate_rectangle.within(mg_boundary_projected_geom):
-            continue
-        
-        if candidate_rectangle.within(ucs_unified_projected_geom):
-            continue
-
-        if candidate_rectangle.distance(ucs_unified_projected_geom) > max_distance_m:
-            continue
-
-        if not candidate_rectangle.intersects(roads_unified_projected_geom):
-            continue
-            
-        if any(candidate_rectangle.intersects(p) for p in generated_polygons):
-            continue
-
-        generated_polygons.append(candidate_rectangle)
-        print(f"AE {len(generated_polygons)}/{NUM_AE_TO_GENERATE} gerada. (Tentativa {attempts})")
+    feasible_region = None
+    if USE_FEASIBLE_REGION:
+        key_parts = [layer_cache.checksum(layer) for layer in (MG_BOUNDARY_LAYER, UC_LAYER, ROADS_LAYER)]
+        key_parts += [CRS_PROJECTED, str(AE_WIDTH_KM), str(AE_HEIGHT_KM), str(BUFFER_DISTANCE_KM)]
+        cache_key = hashlib.sha256('|'.join(key_parts).encode()).hexdigest()[:16]
+        feasible_region = load_or_build_feasible_region(
+            cache_key, mg_boundary_projected_geom, uc_index,
+            roads_index, width_m, height_m, max_distance_m
+        )
+        if feasible_region.is_empty or feasible_region.area == 0:
+            print("Aviso: Região viável vazia. Nenhuma AE pode ser gerada com os parâmetros atuais.")
+            print("\nScript 01 finalizado.")
+            return
+        shapely.prepare(feasible_region)
+
+    # Geometria preparada acelera os predicados vetorizados
+    shapely.prepare(mg_boundary_projected_geom)
+    context = {
+        'mg_geom': mg_boundary_projected_geom,
+        'uc_index': uc_index,
+        'roads_index': roads_index,
+        'feasible_region': feasible_region,
+        'width_m': width_m,
+        'height_m': height_m,
+        'max_distance_m': max_distance_m,
+    }
 
+    if NUM_SCENARIOS > 1:
+        #3. GERANDO CENÁRIOS EM PARALELO
+        print(f"\nGerando {NUM_SCENARIOS} cenários de {NUM_AE_TO_GENERATE} retângulos com {NUM_WORKERS} processos...")
+        scenarios = generate_scenarios(context, NUM_SCENARIOS, NUM_WORKERS)
+
+        # 4. SALVAR RESULTADOS
+        print("\nSalvando resultados...")
+        rows = [
+            {'scenario_id': scenario_id, 'aes_id': f'Área de Estudo {i + 1}', 'geometry': polygon}
+            for scenario_id, polygons in sorted(scenarios.items())
+            for i, polygon in enumerate(polygons)
+        ]
+        if rows:
+            gdf_scenarios = gpd.GeoDataFrame(rows, crs=CRS_PROJECTED).to_crs(CRS_GEOGRAPHIC)
+            gdf_scenarios.to_file(DATA_GPKG, layer=SCENARIOS_OUTPUT_LAYER_NAME, driver='GPKG')
+            print(f"{len(gdf_scenarios)} AEs de {NUM_SCENARIOS} cenários salvas na camada '{SCENARIOS_OUTPUT_LAYER_NAME}'.")
+        else:
+            print("Nenhuma AE foi gerada.")
+
+        print("\nScript 01 finalizado.")
+        return
+
+    #3. GERANDO ÁREAS DE ESTUDO SEGUNDO REGRAS
+    print(f"\nGerando {NUM_AE_TO_GENERATE} retângulos...")
+    rng = np.random.default_rng(RANDOM_SEED)
+    generated_polygons, attempts, n_passed = generate_polygons(rng, context)
+
+    print(f"Taxa de aceitação das regras espaciais: {n_passed}/{attempts} ({n_passed / max(attempts, 1):.1%})")
     if len(generated_polygons) < NUM_AE_TO_GENERATE:
         print(f"\nAviso: Apenas {len(generated_polygons)} de {NUM_AE_TO_GENERATE} AEs foram geradas.")
     else:
@@ -111,4 +345,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
@@ -1,6 +1,11 @@
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import shapely
 import os
+from restricoes_espaciais import FeatureIndex, union_by_group
+from cache_camadas import DerivedLayerCache
+from camadas import layer_exists, read_layer
 
 # --- 1. PARÂMETROS ---
 
@@ -8,6 +13,7 @@ import os
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 data_dir = os.path.join(project_root, 'data')
 DATA_GPKG = os.path.join(data_dir, 'Data.gpkg')
+CACHE_DIR = os.path.join(data_dir, 'cache')
 
 # Camadas de Entrada
 AE_LAYER = 'AEs'
@@ -17,6 +23,12 @@ ROADS_LAYER = 'rodovias_minas_gerais_sisema'
 # Camada de Saída
 OUTPUT_LAYER_NAME = 'ADAs'
 
+# Cenários do script 01 (NUM_SCENARIOS > 1): se a camada de AEs dos cenários
+# existe, as ADAs de cada cenário são geradas da mesma forma e salvas, com o
+# scenario_id, em SCENARIOS_OUTPUT_LAYER_NAME
+SCENARIOS_AE_LAYER = 'AEs_cenarios'
+SCENARIOS_OUTPUT_LAYER_NAME = 'ADAs_cenarios'
+
 # Padrões de CRS
 CRS_GEOGRAPHIC = 'EPSG:4674'
 CRS_PROJECTED = 'EPSG:5880'
@@ -24,6 +36,62 @@ CRS_PROJECTED = 'EPSG:5880'
 # Parâmetros da Simulação
 BUFFER_RADIUS_METERS = 500
 
+def build_adas(ae_geoms, roads_index, uc_index, buffer_radius):
+    """
+    Constrói as ADAs de todas as AEs de uma vez. Uma única consulta ao
+    índice de rodovias associa cada segmento às AEs que ele cruza; recorte,
+    união por AE, buffer, interseção com a AE e remoção das UCs são feitos
+    como operações vetorizadas do shapely. O custo cresce com o número de
+    segmentos dentro das AEs, não com o tamanho da malha viária do estado.
+    Retorna um array com a ADA de cada AE (None se não há rodovias na AE).
+    """
+    ae_geoms = np.asarray(ae_geoms, dtype=object)
+    ae_idx, road_idx = roads_index.tree.query(ae_geoms, predicate='intersects')
+
+    roads_clipped = shapely.intersection(roads_index.geometries[road_idx], ae_geoms[ae_idx])
+    roads_by_ae = union_by_group(roads_clipped, ae_idx, len(ae_geoms))
+
+    has_roads = np.flatnonzero(roads_by_ae != None)
+    adas = np.full(len(ae_geoms), None, dtype=object)
+    adas[has_roads] = shapely.intersection(
+        shapely.buffer(roads_by_ae[has_roads], buffer_radius), ae_geoms[has_roads]
+    )
+
+    # Remove apenas as UCs que tocam cada ADA, sem dissolver a camada inteira
+    ucs_by_ada = np.full(len(ae_geoms), None, dtype=object)
+    ucs_by_ada[has_roads] = uc_index.local_unions(adas[has_roads])
+    has_ucs = np.flatnonzero(ucs_by_ada != None)
+    adas[has_ucs] = shapely.difference(adas[has_ucs], ucs_by_ada[has_ucs])
+    return adas
+
+def build_scenario_adas(layer_cache):
+    """
+    Gera as ADAs de todos os cenários de SCENARIOS_AE_LAYER numa única
+    chamada a build_adas (as AEs de cenários diferentes são independentes) e
+    as salva em SCENARIOS_OUTPUT_LAYER_NAME, numeradas dentro de cada cenário.
+    """
+    gdf_scenarios = read_layer(DATA_GPKG, SCENARIOS_AE_LAYER, columns=['scenario_id', 'aes_id']).to_crs(CRS_PROJECTED)
+    extent = gpd.GeoSeries([gdf_scenarios.union_all()], crs=CRS_PROJECTED)
+    uc_index = FeatureIndex.from_gdf(layer_cache.get(UC_LAYER, 'project', CRS_PROJECTED, mask=extent))
+    roads_index = FeatureIndex.from_gdf(layer_cache.get(ROADS_LAYER, 'project', CRS_PROJECTED, mask=extent))
+
+    ada_geoms = build_adas(gdf_scenarios.geometry.values, roads_index, uc_index, BUFFER_RADIUS_METERS)
+    generated = np.array([geom is not None and not geom.is_empty for geom in ada_geoms], dtype=bool)
+    gdf_ada = gpd.GeoDataFrame(
+        gdf_scenarios.loc[generated, ['scenario_id', 'aes_id']].reset_index(drop=True),
+        geometry=list(ada_geoms[generated]), crs=CRS_PROJECTED
+    )
+    print(f"{len(gdf_ada)} ADAs geradas para {len(gdf_scenarios)} AEs de "
+          f"{gdf_scenarios['scenario_id'].nunique()} cenários.")
+    if gdf_ada.empty:
+        return
+
+    numbers = gdf_ada.groupby('scenario_id').cumcount() + 1
+    gdf_ada['adas_id'] = [f'Área Diretamente Afetada {n}' for n in numbers]
+    gdf_ada = gdf_ada[['scenario_id', 'adas_id', 'aes_id', 'geometry']]
+    gdf_ada.to_crs(CRS_GEOGRAPHIC).to_file(DATA_GPKG, layer=SCENARIOS_OUTPUT_LAYER_NAME, driver='GPKG')
+    print(f"ADAs dos cenários salvas na camada '{SCENARIOS_OUTPUT_LAYER_NAME}'.")
+
 def main():
     """
     Função principal para gerar as Áreas Diretamente Afetadas (ADAs)
@@ -34,38 +102,32 @@ def main():
     # 2. CARREGAR DADOS
     print(f"Carregando dados de: {DATA_GPKG}")
 
-    gdf_ae_projected = gpd.read_file(DATA_GPKG, layer=AE_LAYER).to_crs(CRS_PROJECTED)
+    gdf_ae_projected = read_layer(DATA_GPKG, AE_LAYER, columns=['aes_id']).to_crs(CRS_PROJECTED)
     print("AEs carregadas.")
 
-    all_ucs = gpd.read_file(DATA_GPKG, layer=UC_LAYER)
-    ucs_unified_geom = all_ucs.to_crs(CRS_PROJECTED).union_all()
-    print("UCs carregadas.")
+    # UCs e rodovias já reprojetadas vêm do cache compartilhado, lidas só onde
+    # tocam as AEs (a ADA fica contida na AE)
+    layer_cache = DerivedLayerCache(DATA_GPKG, CACHE_DIR)
+    ae_extent = gpd.GeoSeries([gdf_ae_projected.union_all()], crs=CRS_PROJECTED)
+    all_ucs = layer_cache.get(UC_LAYER, 'project', CRS_PROJECTED, mask=ae_extent)
+    uc_index = FeatureIndex.from_gdf(all_ucs)
+    print(f"{len(all_ucs)} UCs carregadas no entorno das AEs.")
 
-    gdf_roads_projected = gpd.read_file(DATA_GPKG, layer=ROADS_LAYER).to_crs(CRS_PROJECTED)
-    print("Rodovias carregadas.")
+    gdf_roads_projected = layer_cache.get(ROADS_LAYER, 'project', CRS_PROJECTED, mask=ae_extent)
+    print(f"{len(gdf_roads_projected)} segmentos de rodovias carregados no entorno das AEs.")
 
     # 3. GERAR ADAs
     print("\nGerando ADAs...")
     all_generated_adas = []
 
-    for index, ae in gdf_ae_projected.iterrows():
-        aes_id = ae['aes_id']
-        ae_geom = ae['geometry']
-        print(f"Processando {aes_id}...")
-        
-        roads_in_ae = gpd.clip(gdf_roads_projected, ae_geom)
-        
-        if roads_in_ae.empty:
+    roads_index = FeatureIndex.from_gdf(gdf_roads_projected)
+    ada_geoms = build_adas(gdf_ae_projected.geometry.values, roads_index, uc_index, BUFFER_RADIUS_METERS)
+
+    for aes_id, final_ada_geom in zip(gdf_ae_projected['aes_id'], ada_geoms):
+        if final_ada_geom is None:
             print(f"Aviso: Nenhuma rodovia encontrada em {aes_id}.")
             continue
-        
-        roads_to_buffer = roads_in_ae.union_all()
-        ada_candidate = roads_to_buffer.buffer(BUFFER_RADIUS_METERS)
-        
-        ada_clipped_to_ae = ada_candidate.intersection(ae_geom)
-        
-        final_ada_geom = ada_clipped_to_ae.difference(ucs_unified_geom)
-        
+
         if final_ada_geom.is_empty:
             print(f"Aviso: ADA vazia para {aes_id} após remoção de UCs.")
             continue
@@ -88,6 +150,11 @@ def main():
     else:
         print("Nenhuma ADA foi gerada.")
 
+    # 5. ADAs DOS CENÁRIOS
+    if layer_exists(DATA_GPKG, SCENARIOS_AE_LAYER):
+        print(f"\nGerando ADAs dos cenários de '{SCENARIOS_AE_LAYER}'...")
+        build_scenario_adas(layer_cache)
+
     print("\nScript 02 finalizado.")
 
 if __name__ == '__main__':
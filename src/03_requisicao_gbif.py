@@ -1,16 +1,24 @@
 import geopandas as gpd
 import pandas as pd
-from pygbif import occurrences as occ
 import os
+import argparse
+import hashlib
+import math
+from camadas import deduplicate_layer, delete_rows, read_layer, read_table, upsert_layer, write_table
+from gbif_cliente import GbifClient, GBIF_API_URL, PAGE_SIZE, PageStream, create_cached_session, evict_cache
+from planejador_gbif import assign_points, plan_tiles
+from restricoes_espaciais import FeatureIndex
 
 # 1. PARÂMETROS
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 data_dir = os.path.join(project_root, 'data')
 DATA_GPKG = os.path.join(data_dir, 'Data.gpkg')
+CACHE_PATH = os.path.join(data_dir, 'cache', 'gbif_http.sqlite')
 
 # Camadas de Entrada e Saída
 AE_LAYER = 'AEs'
 OUTPUT_LAYER_NAME = 'gbif_occurrences'
+SYNC_STATE_TABLE = 'gbif_sync_state'
 
 # Padrões de CRS
 CRS_LOCAL = 'EPSG:4674'
@@ -18,7 +26,20 @@ CRS_API = 'EPSG:4326'
 
 # Parâmetros da consulta
 CLASS_KEY_AVES = 212
-LIMIT_PER_AE = 1000
+
+# Paginação e concorrência das requisições
+MAX_CONCURRENT_REQUESTS = 4
+MAX_RETRIES = 5
+
+# Planejador de consultas: AEs próximas são consultadas juntas em um retângulo
+# e os pontos são atribuídos a cada AE localmente (graus, em CRS_API)
+USE_QUERY_PLANNER = True
+MAX_TILE_SIZE_DEG = 1.0
+MAX_TILE_OVERHEAD = 4.0
+
+# Cache persistente das respostas da API
+CACHE_TTL_DAYS = 30
+CACHE_MAX_SIZE_MB = 500
 
 # Colunas de interesse
 GBIF_COLUMNS = [
@@ -27,16 +48,82 @@ GBIF_COLUMNS = [
     'stateProvince', 'datasetName', 'recordedBy'
 ]
 
-def main():
+def geometry_hash(geom):
+    """Hash da geometria (WKB) usado para detectar AEs alteradas."""
+    return hashlib.sha256(geom.wkb).hexdigest()
+
+def read_sync_state():
+    """
+    Estado da última sincronização por AE: {aes_id: (hash da geometria,
+    maior lastInterpreted recebido)}.
+    """
+    df = read_table(DATA_GPKG, SYNC_STATE_TABLE)
+    if df is None:
+        return {}
+    return {row.aes_id: (row.geometry_hash, row.last_interpreted) for row in df.itertuples()}
+
+def write_sync_state(state):
+    df = pd.DataFrame(
+        [(aes_id, geom_hash, hwm) for aes_id, (geom_hash, hwm) in state.items()],
+        columns=['aes_id', 'geometry_hash', 'last_interpreted']
+    )
+    write_table(df, DATA_GPKG, SYNC_STATE_TABLE)
+
+def records_to_frame(records):
+    """
+    DataFrame de uma página de registros brutos da API, sempre com todas as
+    colunas de GBIF_COLUMNS (para que as páginas anexadas à camada tenham o
+    mesmo esquema) e com `lastInterpreted`, usada na sincronização.
+    """
+    df = pd.DataFrame.from_records(records).reindex(columns=GBIF_COLUMNS + ['lastInterpreted'])
+    text_columns = [col for col in GBIF_COLUMNS if col not in ('key', 'decimalLatitude', 'decimalLongitude')]
+    df[text_columns] = df[text_columns].astype(object)
+    return df
+
+def process_page(df):
+    """
+    Converte uma página (já com a coluna 'aes_id') em um GeoDataFrame em
+    CRS_LOCAL, com uma linha por gbifID. Retorna None se nenhum registro
+    da página tiver coordenadas.
+    """
+    df = df.drop(columns=['lastInterpreted']).rename(columns={'key': 'gbifID'})
+    df['n_individuals'] = 1
+    df = df.dropna(subset=['decimalLongitude', 'decimalLatitude'])
+    df = df.drop_duplicates(subset='gbifID', keep='first')
+
+    if df.empty:
+        return None
+
+    return gpd.GeoDataFrame(
+        df,
+        geometry=gpd.points_from_xy(df.decimalLongitude, df.decimalLatitude),
+        crs=CRS_API
+    ).to_crs(CRS_LOCAL)
+
+def build_query(geometry_wkt, last_interpreted_filter=None):
+    query = {
+        'classKey': CLASS_KEY_AVES,
+        'geometry': geometry_wkt,
+        'hasCoordinate': 'true',
+    }
+    if last_interpreted_filter:
+        query['lastInterpreted'] = last_interpreted_filter
+    return query
+
+def main(offline=False, incremental=False):
     """
     Função principal para baixar ocorrências de aves do GBIF para cada AE.
+    Com `offline=True` as respostas vêm apenas do cache local. Com
+    `incremental=True` só são pedidos os registros interpretados desde a
+    última sincronização (ou todos, para AEs novas ou com geometria
+    alterada), e a camada é atualizada por gbifID em vez de reescrita.
     """
     print("Iniciando Script 03: Download de dados do GBIF")
 
     # 2. CARREGAR DADOS
     print(f"Carregando AEs de '{DATA_GPKG}'...")
     try:
-        gdf_ae = gpd.read_file(DATA_GPKG, layer=AE_LAYER)
+        gdf_ae = read_layer(DATA_GPKG, AE_LAYER, columns=['aes_id'])
     except Exception as e:
         print(f"Erro: Não foi possível ler a camada '{AE_LAYER}'.")
         print(e)
@@ -46,80 +133,147 @@ def main():
     print(f"{len(gdf_ae)} AEs carregadas.")
 
     # 3. CONSULTAR GBIF
-    all_occurrences_dfs = []
+    previous_state = read_sync_state() if incremental else {}
+    ae_hashes = {aes_id: geometry_hash(geom) for aes_id, geom in zip(gdf_ae['aes_id'], gdf_ae.geometry)}
+    changed_aes = [aes_id for aes_id, h in ae_hashes.items()
+                   if aes_id not in previous_state or previous_state[aes_id][0] != h]
+    removed_aes = [aes_id for aes_id in previous_state if aes_id not in ae_hashes]
+    if incremental:
+        print(f"Sincronização incremental: {len(changed_aes)} AEs novas ou alteradas, "
+              f"{len(ae_hashes) - len(changed_aes)} inalteradas, {len(removed_aes)} removidas.")
+
+    ae_ids = list(gdf_ae['aes_id'])
+    geoms_api = gdf_ae.geometry.to_crs(CRS_API).values
+    # Filtro incremental de cada AE (None = todos os registros)
+    ae_filters = {}
+    for aes_id in ae_ids:
+        last_interpreted = previous_state.get(aes_id, (None, None))[1]
+        ae_filters[aes_id] = f"{last_interpreted[:10]},*" if aes_id not in changed_aes and last_interpreted else None
+
+    queries, query_members = {}, {}
+    if USE_QUERY_PLANNER:
+        # Só AEs com o mesmo filtro podem dividir uma consulta
+        ae_index = FeatureIndex(geoms_api)
+        for filter_value in dict.fromkeys(ae_filters.values()):
+            idx = [i for i, aes_id in enumerate(ae_ids) if ae_filters[aes_id] == filter_value]
+            for tile, tile_members in plan_tiles(geoms_api[idx], MAX_TILE_SIZE_DEG, MAX_TILE_OVERHEAD):
+                key = f"Bloco {len(queries) + 1}"
+                queries[key] = build_query(tile.wkt, filter_value)
+                query_members[key] = [ae_ids[idx[j]] for j in tile_members]
+        print(f"Planejador: {len(queries)} consultas em blocos em vez de {len(ae_ids)} consultas por AE "
+              f"({len(ae_ids) - len(queries)} a menos).")
+    else:
+        for aes_id, geom_api in zip(ae_ids, geoms_api):
+            queries[aes_id] = build_query(geom_api.wkt, ae_filters[aes_id])
+            query_members[aes_id] = [aes_id]
+
     print("\nConsultando a API do GBIF...")
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    session = create_cached_session(CACHE_PATH, ttl_days=CACHE_TTL_DAYS, offline=offline)
+    if offline:
+        print("Modo offline: usando apenas respostas em cache.")
+    # A sessão com cache em SQLite é compartilhada entre as threads
+    client = GbifClient(base_url=GBIF_API_URL, session_factory=lambda: session,
+                        max_retries=0 if offline else MAX_RETRIES)
+    stream = PageStream(client, queries, max_workers=MAX_CONCURRENT_REQUESTS)
 
-    for index, ae in gdf_ae.iterrows():
-        # MUDANÇA CRÍTICA: Usa o nome de coluna correto 'aes_id'
-        aes_id = ae['aes_id']
-        geom_local = ae['geometry']
-        
-        print(f"Consultando para {aes_id}...", end=' ')
-
-        try:
-            geom_api = gpd.GeoSeries([geom_local], crs=CRS_LOCAL).to_crs(CRS_API).iloc[0]
-            
-            response = occ.search(
-                classKey=CLASS_KEY_AVES,
-                geometry=geom_api.wkt,
-                limit=LIMIT_PER_AE,
-                hasCoordinate=True
-            )
-
-            records = response['results']
-            
-            if records:
-                print(f"Encontrados {len(records)} registros.")
-                df = pd.DataFrame(records)
-                # MUDANÇA CRÍTICA: Cria a coluna com o nome correto 'aes_id'
-                df['aes_id'] = aes_id
-                all_occurrences_dfs.append(df)
+    # 4. PROCESSAR E SALVAR CADA PÁGINA À MEDIDA QUE CHEGA
+    # Cada página é filtrada, convertida e gravada na camada antes da próxima,
+    # então a memória não cresce com o total de ocorrências.
+    print(f"Gravando ocorrências na camada '{OUTPUT_LAYER_NAME}' à medida que chegam...")
+    last_interpreted_by_ae = {}
+    records_by_ae = dict.fromkeys(ae_ids, 0)
+    cleared_aes = set()
+    n_written, n_updated = 0, 0
+    try:
+        n_deleted = delete_rows(DATA_GPKG, OUTPUT_LAYER_NAME, 'aes_id', removed_aes) if incremental else 0
+        for key, records in stream:
+            df = records_to_frame(records)
+            if USE_QUERY_PLANNER:
+                # Atribuição local dos pontos do bloco às AEs que ele cobre
+                assigned = assign_points(df['decimalLongitude'], df['decimalLatitude'], ae_index)
+                df['aes_id'] = [ae_ids[i] if i >= 0 else None for i in assigned]
+                df = df[df['aes_id'].isin(query_members[key])]
             else:
-                print("Nenhum registro encontrado.")
+                df['aes_id'] = key
 
-        except Exception as e:
-            print(f"Erro na consulta para {aes_id}: {e}")
+            for aes_id, group in df.groupby('aes_id'):
+                records_by_ae[aes_id] += len(group)
+                interpreted = group['lastInterpreted'].dropna()
+                if not interpreted.empty:
+                    last_interpreted_by_ae[aes_id] = max(interpreted.max(), last_interpreted_by_ae.get(aes_id, ''))
 
-    # 4. PROCESSAR E CONVERTER DADOS
-    if not all_occurrences_dfs:
-        print("\nNenhum registro baixado. Encerrando.")
-        return
+            gdf_page = process_page(df)
+            if gdf_page is None:
+                continue
+
+            if incremental:
+                # Registros antigos de AEs alteradas saem antes dos novos serem gravados
+                for aes_id in gdf_page['aes_id'].unique():
+                    if aes_id in changed_aes and aes_id not in cleared_aes:
+                        n_deleted += delete_rows(DATA_GPKG, OUTPUT_LAYER_NAME, 'aes_id', [aes_id])
+                        cleared_aes.add(aes_id)
+                inserted, updated = upsert_layer(DATA_GPKG, OUTPUT_LAYER_NAME, gdf_page, 'gbifID')
+                n_written += inserted; n_updated += updated
+            else:
+                if not n_written:
+                    # A camada vai ser reescrita: o estado anterior é apagado antes
+                    # da primeira gravação, para que uma interrupção no meio não
+                    # deixe uma camada truncada que o modo incremental tome por completa
+                    write_sync_state({})
+                gdf_page.to_file(DATA_GPKG, layer=OUTPUT_LAYER_NAME, driver='GPKG',
+                                 mode='a' if n_written else 'w')
+                n_written += len(gdf_page)
 
-    print("\nProcessando registros baixados...")
-    
-    final_df = pd.concat(all_occurrences_dfs, ignore_index=True)
-
-    cols_to_keep = [col for col in GBIF_COLUMNS if col in final_df.columns]
-    # MUDANÇA CRÍTICA: Adiciona a coluna com o nome correto 'aes_id'
-    cols_to_keep.append('aes_id')
-    
-    processed_df = final_df[cols_to_keep].copy()
-    processed_df.rename(columns={'key': 'gbifID'}, inplace=True)
-    processed_df['n_individuals'] = 1
-    processed_df.dropna(subset=['decimalLongitude', 'decimalLatitude'], inplace=True)
-    
-    if processed_df.empty:
-        print("Nenhum registro válido com coordenadas.")
+        failed_aes = {aes_id for key in stream.failed for aes_id in query_members[key]}
+        if incremental:
+            # AEs alteradas cuja consulta terminou sem nenhum registro (ex.: área
+            # sem ocorrências) também perdem os registros antigos; as que falharam
+            # os mantêm, junto com o estado anterior
+            pending = [aes_id for aes_id in changed_aes if aes_id not in cleared_aes and aes_id not in failed_aes]
+            n_deleted += delete_rows(DATA_GPKG, OUTPUT_LAYER_NAME, 'aes_id', pending)
+        else:
+            # Registros que caem em mais de uma geometria de consulta ficam com a primeira AE
+            n_written -= deduplicate_layer(DATA_GPKG, OUTPUT_LAYER_NAME, 'gbifID')
+    except Exception as e:
+        print(f"Erro ao salvar: {e}")
+        print("\nScript 03 finalizado.")
         return
+    finally:
+        if not offline:
+            evict_cache(session, CACHE_MAX_SIZE_MB)
 
-    gdf_occurrences_api_crs = gpd.GeoDataFrame(
-        processed_df,
-        geometry=gpd.points_from_xy(processed_df.decimalLongitude, processed_df.decimalLatitude),
-        crs=CRS_API
-    )
+    if USE_QUERY_PLANNER:
+        # Sem o planejador, cada AE pediria ao menos uma página
+        pages_per_ae = sum(max(1, math.ceil(n / PAGE_SIZE)) for n in records_by_ae.values())
+        pages_done = sum(stream.pages.values())
+        print(f"Planejador: {pages_done} requisições feitas; consultas por AE exigiriam ~{pages_per_ae}.")
 
-    # 5. SALVAR RESULTADOS
-    print(f"Convertendo {len(gdf_occurrences_api_crs)} ocorrências para {CRS_LOCAL}...")
-    gdf_occurrences_local_crs = gdf_occurrences_api_crs.to_crs(CRS_LOCAL)
+    # Estado das AEs consultadas com sucesso; as que falharam mantêm o anterior
+    new_state = {aes_id: previous_state[aes_id] for aes_id in previous_state if aes_id in ae_hashes}
+    for aes_id in ae_ids:
+        if aes_id in failed_aes:
+            continue
+        last_interpreted = last_interpreted_by_ae.get(aes_id) or None
+        if aes_id not in changed_aes:
+            last_interpreted = max(filter(None, [last_interpreted, previous_state[aes_id][1]]), default=None)
+        new_state[aes_id] = (ae_hashes[aes_id], last_interpreted)
+
+    if incremental:
+        write_sync_state(new_state)
+        print(f"{n_written} registros inseridos, {n_updated} atualizados, {n_deleted} removidos.")
+    elif n_written:
+        write_sync_state(new_state)
+        print(f"{n_written} ocorrências salvas com sucesso.")
+    else:
+        print("\nNenhum registro válido baixado.")
 
-    print(f"Salvando resultados na camada '{OUTPUT_LAYER_NAME}'...")
-    try:
-        gdf_occurrences_local_crs.to_file(DATA_GPKG, layer=OUTPUT_LAYER_NAME, driver='GPKG')
-        print("Dados salvos com sucesso.")
-    except Exception as e:
-        print(f"Erro ao salvar: {e}")
-        
     print("\nScript 03 finalizado.")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Download de ocorrências de aves do GBIF para cada AE.")
+    parser.add_argument('--offline', action='store_true', help="Usa apenas respostas do cache local, sem acessar a rede.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Baixa apenas registros novos e atualiza a camada por gbifID, sem reescrevê-la.")
+    args = parser.parse_args()
+    main(offline=args.offline, incremental=args.incremental)
\ No newline at end of file
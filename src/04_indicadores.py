@@ -2,9 +2,13 @@ import geopandas as gpd
 import pandas as pd
 import warnings
 import os
-import rasterio
 import numpy as np
-from rasterstats import zonal_stats
+import shapely
+from estatisticas_zonais import TileHistogramIndex, class_fractions, compute_zonal_stats_parallel, top_two_categories
+from restricoes_espaciais import FeatureIndex
+from camadas import read_layer, read_layer_near, update_layers
+from cache_camadas import DerivedLayerCache
+from registro_indicadores import IndicatorInputs, IndicatorRegistry, IndicatorStore
 
 # --- 1. PARÂMETROS ---
 
@@ -12,6 +16,7 @@ from rasterstats import zonal_stats
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 data_dir = os.path.join(project_root, 'data')
 DATA_GPKG = os.path.join(data_dir, 'Data.gpkg')
+CACHE_DIR = os.path.join(data_dir, 'cache')
 MDE_RASTER_PATH = os.path.join(data_dir, 'raster', 'modelo_digital_elevacao_inpe.tif')
 USO_RASTER_PATH = os.path.join(data_dir, 'raster', 'uso_ocupacao_map_biomas.tif')
 
@@ -28,22 +33,128 @@ LAYER_NAMES = {
     'uc': 'unidades_conservacao_sisema',
 }
 
-# Camadas que serão copiadas para o novo arquivo sem alterações
-LAYERS_TO_KEEP_AS_IS = [
-    'gbif_occurrences', 'limites_minas_gerais_sisema',
-    'unidades_conservacao_sisema'
-]
+# Raios (km) das contagens de UCs no entorno (colunas n_ucs_raio_<raio>km)
+UC_COUNT_RADII_KM = [1, 5, 10, 20]
+
+# Raio (além das AEs) em que as UCs são lidas. Se alguma feição não tiver UC
+# dentro desse raio, a camada inteira é lida para a distância até a UC.
+UC_SEARCH_DISTANCE_KM = 30
+
+# Colunas da camada de ocorrências usadas pelos indicadores
+GBIF_COLUMNS = ['scientificName', 'gbifID', 'n_individuals']
 
-BUFFER_RADIUS_KM = 5
+# Coluna com o nome da UC na camada de UCs (o id da UC é o fid da camada)
+UC_NAME_COLUMN = 'nome_uc'
 
-# --- FUNÇÃO AUXILIAR ---
-def get_top_two_categories(counts_dict):
-    if not counts_dict or not isinstance(counts_dict, dict):
-        return np.nan, np.nan
-    sorted_items = sorted(counts_dict.items(), key=lambda item: item[1], reverse=True)
-    majority = sorted_items[0][0]
-    second_majority = sorted_items[1][0] if len(sorted_items) > 1 else np.nan
-    return majority, second_majority
+# Colunas calculadas por este script (descartadas na leitura e recalculadas)
+INDICATOR_COLUMNS = [
+    'area_ha', 'riqueza_especies', 'n_registros', 'n_individuos', 'dist_uc_km', 'uc_proxima_id',
+    'uc_proxima_nome', 'elevacao_media', 'elevacao_min', 'elevacao_max', 'relevo_m', 'uso_solo_1', 'uso_solo_2',
+]
+INDICATOR_PREFIXES = ('n_ucs_raio_', 'uso_solo_frac_')
+
+# Estatísticas zonais em paralelo: nº de processos (1 = sem paralelismo) e
+# nº de polígonos por bloco enviado a cada processo
+ZONAL_STATS_WORKERS = os.cpu_count()
+ZONAL_STATS_CHUNK_SIZE = 64
+
+# Exporta também a fração de área de cada classe de uso do solo (uso_solo_frac_<código>)
+EXPORT_LAND_USE_FRACTIONS = False
+
+# Índice de histogramas por bloco do raster de uso do solo (construído uma vez
+# e reconstruído quando o checksum do raster muda). Blocos inteiramente
+# dentro de um polígono são somados sem ler pixels.
+USE_LAND_USE_TILE_INDEX = True
+LAND_USE_TILE_SIZE = 256
+LAND_USE_INDEX_PATH = os.path.join(data_dir, 'cache', 'uso_ocupacao_map_biomas.hist.npz')
+
+# Resultados dos indicadores por feição (hash da geometria), reaproveitados
+# entre execuções enquanto as entradas de cada indicador não mudam
+INDICATOR_STORE_DIR = os.path.join(data_dir, 'cache', 'indicadores')
+# Nº de indicadores calculados ao mesmo tempo (None = todos)
+INDICATOR_WORKERS = None
+
+# --- INDICADORES ---
+# Cada indicador recebe as feições a calcular (CRS_LOCAL) e as entradas
+# declaradas, e devolve um DataFrame com o mesmo índice das feições.
+REGISTRY = IndicatorRegistry()
+
+@REGISTRY.register('area', params={'crs': CRS_PROJECTED})
+def area_indicator(features, inputs, crs):
+    return pd.DataFrame({'area_ha': features.to_crs(crs).geometry.area / 10000}, index=features.index)
+
+@REGISTRY.register('avifauna', inputs=['gbif'])
+def gbif_indicator(features, inputs):
+    gbif = inputs.get('gbif')
+    joined = gpd.sjoin(gbif[['scientificName', 'gbifID', 'n_individuals', 'geometry']],
+                       features[['geometry']].reset_index(drop=True), how='inner', predicate='within')
+    agg = joined.groupby('index_right').agg(
+        riqueza_especies=('scientificName', 'nunique'), n_registros=('gbifID', 'count'),
+        n_individuos=('n_individuals', 'sum'))
+    return agg.reindex(range(len(features))).set_axis(features.index)
+
+@REGISTRY.register('proximidade_ucs', inputs=['uc'],
+                   params={'radii_km': UC_COUNT_RADII_KM, 'name_column': UC_NAME_COLUMN, 'crs': CRS_PROJECTED})
+def uc_proximity_indicator(features, inputs, radii_km, name_column, crs):
+    # Uma consulta ao índice dá a UC mais próxima e as contagens por raio
+    ucs = inputs.get('uc')
+    nearest_uc, nearest_m, uc_counts = FeatureIndex.from_gdf(ucs).proximity(
+        features.to_crs(crs).geometry.values, [r * 1000 for r in radii_km]
+    )
+    found = nearest_uc >= 0
+    result = pd.DataFrame(index=features.index)
+    result['dist_uc_km'] = nearest_m / 1000
+    result['uc_proxima_id'] = np.where(found, ucs.index.to_numpy()[nearest_uc], -1)
+    if name_column in ucs.columns:
+        result['uc_proxima_nome'] = np.where(found, ucs[name_column].to_numpy()[nearest_uc], None)
+    for j, radius in enumerate(radii_km):
+        result[f'n_ucs_raio_{radius:g}km'] = uc_counts[:, j]
+    return result
+
+@REGISTRY.register('rasters', inputs=['mde', 'uso'], params={'fractions': EXPORT_LAND_USE_FRACTIONS})
+def raster_indicator(features, inputs, fractions):
+    # Elevação e uso do solo numa única passada das estatísticas zonais: a
+    # máscara de cada polígono é calculada uma vez e os rasters são abertos
+    # uma vez por processo. Rasters ausentes (entrada None) são pulados.
+    raster_paths = {key: inputs.get(key) for key in ['mde', 'uso'] if inputs.get(key) is not None}
+    result = pd.DataFrame(index=features.index)
+    if not raster_paths:
+        return result
+    histogram_indexes = {}
+    if 'uso' in raster_paths and USE_LAND_USE_TILE_INDEX:
+        try:
+            TileHistogramIndex.load_or_build(raster_paths['uso'], LAND_USE_INDEX_PATH, LAND_USE_TILE_SIZE)
+            histogram_indexes['uso'] = LAND_USE_INDEX_PATH
+        except ValueError as e:
+            print(f"Aviso: índice de histogramas não utilizado. {e}")
+    stats = compute_zonal_stats_parallel(features, raster_paths, categorical=[k for k in ['uso'] if k in raster_paths],
+                                         num_workers=ZONAL_STATS_WORKERS, chunk_size=ZONAL_STATS_CHUNK_SIZE,
+                                         histogram_indexes=histogram_indexes)
+    if 'mde' in stats:
+        result['elevacao_media'] = stats['mde']['mean']
+        result['relevo_m'] = stats['mde']['max'] - stats['mde']['min']
+    if 'uso' in stats:
+        result['uso_solo_1'], result['uso_solo_2'] = top_two_categories(stats['uso'])
+        if fractions:
+            result = result.join(class_fractions(stats['uso']).add_prefix('uso_solo_frac_').fillna(0))
+    return result
+
+def read_ucs_near(layer_cache, geometries):
+    """
+    UCs já reprojetadas (cache de camadas) até UC_SEARCH_DISTANCE_KM de
+    `geometries` (AEs e ADAs, estas contidas nas AEs). Se alguma geometria
+    não tiver UC nesse raio, a mais próxima pode ter ficado de fora da
+    leitura, e a camada inteira é usada.
+    """
+    search_m = max(max(UC_COUNT_RADII_KM), UC_SEARCH_DISTANCE_KM) * 1000
+    geometries = geometries.to_crs(CRS_PROJECTED)
+    extent = gpd.GeoSeries([geometries.union_all().buffer(search_m)], crs=CRS_PROJECTED)
+    ucs = layer_cache.get(LAYER_NAMES['uc'], 'project', CRS_PROJECTED, mask=extent)
+    feature_idx, _ = shapely.STRtree(ucs.geometry.values).query(geometries.values, predicate='dwithin', distance=search_m)
+    if len(np.unique(feature_idx)) < len(geometries):
+        print("Aviso: UC mais próxima fora do raio de leitura. Carregando todas as UCs...")
+        ucs = layer_cache.get(LAYER_NAMES['uc'], 'project', CRS_PROJECTED)
+    return ucs
 
 def main():
     print("Iniciando Script 04: Cálculo de Indicadores")
@@ -52,112 +163,74 @@ def main():
     print(f"Carregando dados de: {DATA_GPKG}")
     gdfs = {}
     try:
-        for key, name in LAYER_NAMES.items():
-            gdfs[key] = gpd.read_file(DATA_GPKG, layer=name)
+        gdfs['ae'] = read_layer(DATA_GPKG, LAYER_NAMES['ae'])
+        gdfs['ada'] = read_layer(DATA_GPKG, LAYER_NAMES['ada'])
+        for key in ['ae', 'ada']:
+            previous = [c for c in gdfs[key].columns if c in INDICATOR_COLUMNS or c.startswith(INDICATOR_PREFIXES)]
+            gdfs[key] = gdfs[key].drop(columns=previous)
         print("Camadas carregadas.")
     except Exception as e:
         print(f"Erro ao carregar dados: {e}"); return
-    
-    ucs_projected_unified = gdfs['uc'].to_crs(CRS_PROJECTED).union_all()
-
-    # --- 3. CÁLCULO DE INDICADORES VETORIAIS ---
-    print("\nCalculando indicadores vetoriais...")
-    gdf_ada = gdfs['ada']; gdf_ae = gdfs['ae']
-    for gdf, id_col, name in [(gdf_ada, 'adas_id', 'ADAs'), (gdf_ae, 'aes_id', 'AEs')]:
-        gdf_projected = gdf.to_crs(CRS_PROJECTED)
-        gdf['area_ha'] = gdf_projected.geometry.area / 10000
-        
-        # --- CORREÇÃO APLICADA AQUI ---
-        # Prepara o dataframe do GBIF para o join, evitando conflito de colunas.
-        # O conflito só ocorre quando id_col ('aes_id') já existe em gdfs['gbif'].
-        gbif_to_join = gdfs['gbif']
-        if id_col in gbif_to_join.columns:
-            gbif_to_join = gbif_to_join.drop(columns=[id_col])
-
-        sjoined_gbif = gpd.sjoin(gbif_to_join, gdf, how="inner", predicate="within")
-        # --- FIM DA CORREÇÃO ---
-
-        gbif_agg = sjoined_gbif.groupby(id_col).agg(riqueza_especies=('scientificName', 'nunique'), n_registros=('gbifID', 'count'), n_individuos=('n_individuals', 'sum')).reset_index()
-        gdf = gdf.merge(gbif_agg, on=id_col, how='left')
-        gdf['dist_uc_km'] = gdf_projected.geometry.distance(ucs_projected_unified) / 1000
-        gdf_buffer = gdf_projected.copy(); gdf_buffer['geometry'] = gdf_buffer.geometry.buffer(BUFFER_RADIUS_KM * 1000)
-        sjoined_ucs = gpd.sjoin(gdf_buffer[[id_col, 'geometry']], gdfs['uc'].to_crs(CRS_PROJECTED), how='left', predicate='intersects')
-        uc_count = sjoined_ucs.groupby(id_col).size().reset_index(name='n_ucs_raio_5km')
-        gdf = gdf.merge(uc_count, on=id_col, how='left')
-        if name == 'ADAs': gdf_ada = gdf
-        else: gdf_ae = gdf
-    print("Indicadores vetoriais calculados.")
-
-    # --- 4. CÁLCULO DE INDICADORES RASTER ---
-    print("\nCalculando indicadores de rasters...")
-    # 4.1 MDE
-    if not os.path.exists(MDE_RASTER_PATH):
-        print(f"Aviso: Raster MDE não encontrado.")
-    else:
-        with rasterio.open(MDE_RASTER_PATH) as src: raster_crs = src.crs
-        print("Calculando estatísticas do MDE...")
-        for gdf, name in [(gdf_ada, 'ADAs'), (gdf_ae, 'AEs')]:
-            stats = zonal_stats(gdf.to_crs(raster_crs), MDE_RASTER_PATH, stats=['mean', 'min', 'max'])
-            df_stats = pd.DataFrame(stats).rename(columns={'mean': 'elevacao_media', 'min': 'elevacao_min', 'max': 'elevacao_max'})
-            gdf = gdf.join(df_stats)
-            gdf['relevo_m'] = gdf['elevacao_max'] - gdf['elevacao_min']
-            if name == 'ADAs': gdf_ada = gdf
-            else: gdf_ae = gdf
-        print("Indicadores de MDE calculados.")
-
-    # 4.2 Uso do Solo
-    if not os.path.exists(USO_RASTER_PATH):
-        print(f"Aviso: Raster de Uso do Solo não encontrado.")
-    else:
-        with rasterio.open(USO_RASTER_PATH) as src: raster_crs = src.crs
-        print("Calculando estatísticas de Uso do Solo...")
-        for gdf, name in [(gdf_ada, 'ADAs'), (gdf_ae, 'AEs')]:
-            stats = zonal_stats(gdf.to_crs(raster_crs), USO_RASTER_PATH, categorical=True)
-            top_two = [get_top_two_categories(s) for s in stats]
-            gdf['uso_solo_1'] = [item[0] for item in top_two]
-            gdf['uso_solo_2'] = [item[1] for item in top_two]
-            if name == 'ADAs': gdf_ada = gdf
-            else: gdf_ae = gdf
-        print("Indicadores de Uso do Solo calculados.")
-
-    # --- 5. VALIDAÇÃO, FORMATAÇÃO E RECONSTRUÇÃO ---
+
+    # As demais entradas só são lidas se algum indicador precisar ser recalculado
+    store = IndicatorStore(INDICATOR_STORE_DIR)
+    layer_cache = DerivedLayerCache(DATA_GPKG, CACHE_DIR)
+    inputs = IndicatorInputs()
+    # As ADAs estão contidas nas AEs: basta ler as ocorrências no entorno delas,
+    # e só as colunas usadas pelos indicadores
+    inputs.add('gbif', lambda: read_layer_near(DATA_GPKG, LAYER_NAMES['gbif'], gdfs['ae'].geometry,
+                                               crs_projected=CRS_PROJECTED, columns=GBIF_COLUMNS),
+               lambda: layer_cache.checksum(LAYER_NAMES['gbif']))
+    # UCs já reprojetadas vêm do cache compartilhado de camadas derivadas,
+    # lidas só no entorno das feições
+    inputs.add('uc', lambda: read_ucs_near(layer_cache, features.geometry),
+               lambda: layer_cache.checksum(LAYER_NAMES['uc']))
+
+    for key, path, label in [('mde', MDE_RASTER_PATH, 'MDE'), ('uso', USO_RASTER_PATH, 'de Uso do Solo')]:
+        if not os.path.exists(path):
+            print(f"Aviso: Raster {label} não encontrado.")
+            # O indicador de rasters calcula só os que existem
+            inputs.add(key, lambda: None, lambda: None)
+        else:
+            inputs.add(key, lambda path=path: path, lambda path=path: store.file_checksum(path))
+
+    # --- 3. CÁLCULO DE INDICADORES ---
+    print("\nCalculando indicadores...")
+    # ADAs e AEs são calculadas juntas; só feições novas/alteradas são recalculadas
+    features = gpd.GeoDataFrame(
+        geometry=pd.concat([gdfs['ada'].geometry, gdfs['ae'].geometry], keys=['ADAs', 'AEs']), crs=gdfs['ae'].crs
+    )
+    table = REGISTRY.run(features, inputs, store, max_workers=INDICATOR_WORKERS)
+    gdf_ada = gdfs['ada'].join(table.loc['ADAs'])
+    gdf_ae = gdfs['ae'].join(table.loc['AEs'])
+    print("Indicadores calculados.")
+
+    # --- 4. VALIDAÇÃO, FORMATAÇÃO E GRAVAÇÃO ---
     print("\nValidando e formatando resultados...")
     for gdf in [gdf_ae, gdf_ada]:
         if not gdf.is_valid.all():
             print(f"Aviso: Geometrias inválidas detectadas. Corrigindo...")
             gdf.geometry = gdf.buffer(0)
-    
-    # Os nomes de saída agora são os nomes originais, para substituição
-    output_layer_ada = 'ADAs'
-    output_layer_ae = 'AEs'
-    temp_gpkg_path = DATA_GPKG.replace(".gpkg", "_temp.gpkg")
-    print(f"\nReconstruindo GeoPackage...")
-    
+
+    # Só as camadas AEs e ADAs são atualizadas, no próprio GeoPackage e em uma
+    # única transação; as demais camadas não são lidas nem regravadas
+    print(f"\nAtualizando camadas no GeoPackage...")
     try:
-        int_cols = ['riqueza_especies', 'n_registros', 'n_individuos', 'n_ucs_raio_5km', 
+        int_cols = ['riqueza_especies', 'n_registros', 'n_individuos', 'uc_proxima_id',
                     'area_ha', 'dist_uc_km', 'elevacao_media', 'relevo_m',
-                    'uso_solo_1', 'uso_solo_2']
+                    'uso_solo_1', 'uso_solo_2'] + [f'n_ucs_raio_{r:g}km' for r in UC_COUNT_RADII_KM]
         for col in int_cols:
             if col in gdf_ada.columns: gdf_ada[col] = gdf_ada[col].fillna(0).astype(int)
             if col in gdf_ae.columns: gdf_ae[col] = gdf_ae[col].fillna(0).astype(int)
-        
-        gdf_ada.drop(columns=['elevacao_min', 'elevacao_max'], inplace=True, errors='ignore')
-        gdf_ae.drop(columns=['elevacao_min', 'elevacao_max'], inplace=True, errors='ignore')
 
         print(f"Salvando camadas enriquecidas...")
-        gdf_ae.to_file(temp_gpkg_path, layer=output_layer_ae, driver='GPKG')
-        gdf_ada.to_file(temp_gpkg_path, layer=output_layer_ada, driver='GPKG')
-        
-        print("Copiando camadas de base...")
-        for layer_name in LAYERS_TO_KEEP_AS_IS:
-            gdf_to_keep = gpd.read_file(DATA_GPKG, layer=layer_name)
-            gdf_to_keep.to_file(temp_gpkg_path, layer=layer_name, driver='GPKG')
-        
-        os.remove(DATA_GPKG); os.rename(temp_gpkg_path, DATA_GPKG)
-        print("GeoPackage reconstruído com sucesso.")
+        update_layers(DATA_GPKG, {
+            LAYER_NAMES['ae']: (gdf_ae, 'aes_id'),
+            LAYER_NAMES['ada']: (gdf_ada, 'adas_id'),
+        })
+        print("Camadas AEs e ADAs atualizadas com sucesso.")
     except Exception as e:
-        print(f"Erro durante a reconstrução: {e}")
-        if os.path.exists(temp_gpkg_path): os.remove(temp_gpkg_path)
+        print(f"Erro durante a atualização: {e}. As camadas anteriores foram mantidas.")
     print("\nScript 04 finalizado.")
 
 if __name__ == '__main__':
@@ -1,15 +1,24 @@
 import dash
-from dash import dcc, html, dash_table, Input, Output
+from dash import dcc, html, dash_table, ClientsideFunction, Input, Output, Patch, no_update
+from flask import Response, abort, request
 import plotly.graph_objects as go
-import geopandas as gpd
+import plotly.io as pio
 import pandas as pd
+import numpy as np
+import hashlib
 import json
 import os
+from cache_camadas import DerivedLayerCache
+from camadas import layer_version, read_layer
+from painel_indicadores import IndicatorLookup, OccurrencePeriodIndex
+from artefato_painel import DashboardArtifact
+from mapa_camadas import OccurrenceIndex, SimplifiedLayer, band_for_zoom, cell_size_for_zoom, snap_bbox
 
 # --- 1. CONFIGURAÇÃO GERAL ---
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 data_dir = os.path.join(project_root, 'data')
 DATA_GPKG = os.path.join(data_dir, 'Data.gpkg')
+CACHE_DIR = os.path.join(data_dir, 'cache')
 
 CRS_LOCAL = 'EPSG:4674'
 CRS_MAP = 'EPSG:4326'
@@ -22,6 +31,45 @@ LAYER_NAMES = {
     'ucs': 'unidades_conservacao_sisema',
 }
 
+# Camadas de base estáticas: lidas já reprojetadas do cache de camadas derivadas
+CACHED_LAYERS = ['mg_limits', 'ucs']
+
+# Colunas lidas de cada camada (None = todas); das ocorrências, o mapa usa o
+# nome das espécies e os filtros do painel, a data, a ordem e a família
+LAYER_COLUMNS = {'gbif': ['scientificName', 'family', 'order', 'eventDate', 'n_individuals']}
+
+# Indicadores recalculados pelos filtros de período e de ordem/família
+OCCURRENCE_COLUMNS = ['riqueza_especies', 'n_registros', 'n_individuos']
+
+# Mapa: as UCs não vão embutidas na figura; o navegador pede à rota /mapa a
+# versão simplificada da faixa de zoom atual, recortada pela área visível.
+# Faixas: (zoom mínimo, zoom máximo, tolerância em graus; 0 = geometria original)
+MAP_ZOOM = 6
+MAP_ZOOM_BANDS = [(0, 9, 0.005), (9, 12, 0.0005), (12, 24, 0)]
+# Validade (s) das respostas da rota /mapa no cache do navegador
+MAP_CACHE_MAX_AGE = 3600
+# Tolerância (graus) da simplificação do limite de Minas Gerais
+MG_BOUNDARY_TOLERANCE = 0.0005
+
+# Ocorrências do GBIF no mapa: abaixo de GBIF_POINTS_MIN_ZOOM são agregadas em
+# células de ~GBIF_CELL_PIXELS pixels (nº de registros e de espécies); a partir
+# dele vão os pontos da área visível, se forem no máximo GBIF_MAX_POINTS
+GBIF_POINTS_MIN_ZOOM = 11
+GBIF_CELL_PIXELS = 40
+GBIF_MAX_POINTS = 20000
+
+# Figura do mapa, tabela de indicadores e índices do mapa são montados uma vez
+# e guardados como artefato; o app carrega o artefato e o remonta em segundo
+# plano quando as camadas mudam (verificação a cada DASHBOARD_CHECK_INTERVAL_S s)
+DASHBOARD_ARTIFACT_DIR = os.path.join(CACHE_DIR, 'painel')
+DASHBOARD_ARTIFACT_FORMAT = 4
+DASHBOARD_CHECK_INTERVAL_S = 30
+
+# Cartões e gráficos do clique montados no navegador (assets/painel.js), a
+# partir da tabela de indicadores enviada uma vez por página em um dcc.Store;
+# False = callback no servidor a cada clique
+CLIENTSIDE_INDICATORS = True
+
 # --- 2. PAINEL DE CONTROLE DE ESTILOS E APELIDOS ---
 STYLE_CONFIG = {
     'mg_limits': {'color': '#333333', 'width': 2.5, 'name': 'Limite de Minas Gerais'},
@@ -46,6 +94,12 @@ COLUMN_ALIASES = {
     'uso_solo_2': 'Uso do Solo Secundário'
 }
 
+# Indicadores exibidos nos cartões, em ordem
+INDICATOR_CARDS = [
+    'area_ha', 'riqueza_especies', 'n_registros', 'n_individuos', 'dist_uc_km',
+    'n_ucs_raio_5km', 'elevacao_media', 'relevo_m', 'uso_solo_1', 'uso_solo_2'
+]
+
 # Legenda completa baseada na Coleção 10 do MapBiomas
 USO_SOLO_MAP = {
     3: 'Formação Florestal',
@@ -89,170 +143,364 @@ USO_SOLO_MAP = {
 }
 
 # --- 3. CARREGAMENTO DE DADOS ---
-DATA_ERROR_MESSAGE = ""
-gdfs = {}
-try:
+def dashboard_version():
+    """Versão dos dados do painel: estado das camadas no GPKG e parâmetros do mapa."""
+    if not os.path.exists(DATA_GPKG):
+        raise FileNotFoundError(DATA_GPKG)
+    state = [layer_version(DATA_GPKG, name) for name in LAYER_NAMES.values()]
+    params = [DASHBOARD_ARTIFACT_FORMAT, CRS_MAP, MAP_ZOOM, MAP_ZOOM_BANDS, MG_BOUNDARY_TOLERANCE,
+              GBIF_CELL_PIXELS, STYLE_CONFIG]
+    return hashlib.sha256(json.dumps([state, params]).encode()).hexdigest()[:16]
+
+def build_dashboard():
+    """Lê as camadas e monta o conteúdo do artefato do painel."""
+    layer_cache = DerivedLayerCache(DATA_GPKG, CACHE_DIR)
+    gdfs = {}
     for key, name in LAYER_NAMES.items():
-        gdfs[key] = gpd.read_file(DATA_GPKG, layer=name)
-    
-    for key in gdfs:
-        gdfs[key] = gdfs[key].to_crs(CRS_MAP)
+        if key in CACHED_LAYERS:
+            gdfs[key] = layer_cache.get(name, 'project', CRS_MAP)
+        else:
+            gdfs[key] = read_layer(DATA_GPKG, name, columns=LAYER_COLUMNS.get(key)).to_crs(CRS_MAP)
+    occurrence_index = OccurrenceIndex(gdfs['gbif'])
     print("-> Carregamento de dados concluído.")
-except Exception as e:
-    DATA_ERROR_MESSAGE = f"ERRO AO CARREGAR DADOS: {e}"
+    return {
+        # Atributos das AEs/ADAs indexados em memória para o callback de clique
+        'indicator_lookup': IndicatorLookup(DATA_GPKG, LAYER_NAMES['ae'], LAYER_NAMES['ada']),
+        'map_layers': {'ucs': SimplifiedLayer(gdfs['ucs'], MAP_ZOOM_BANDS, properties=['nome_uc'],
+                                              version=layer_cache.checksum(LAYER_NAMES['ucs']))},
+        'occurrence_index': occurrence_index,
+        # Ocorrências de cada AE/ADA por data e táxon, para os filtros do painel
+        'occurrence_periods': {
+            'aes': OccurrencePeriodIndex.from_layers(gdfs['gbif'], gdfs['ae'], 'aes_id'),
+            'adas': OccurrencePeriodIndex.from_layers(gdfs['gbif'], gdfs['ada'], 'adas_id'),
+        },
+        'figure': create_map_figure(gdfs, occurrence_index),
+    }
+
+dashboard = DashboardArtifact(DASHBOARD_ARTIFACT_DIR, dashboard_version, build_dashboard,
+                              check_interval_s=DASHBOARD_CHECK_INTERVAL_S)
+DATA_ERROR_MESSAGE = ""
+
+def current_dashboard():
+    """Conteúdo atual do artefato do painel (None se os dados não puderam ser carregados)."""
+    global DATA_ERROR_MESSAGE
+    try:
+        payload = dashboard.current()
+        DATA_ERROR_MESSAGE = "" if payload is not None else "Os dados do painel estão sendo preparados; recarregue a página em instantes."
+    except Exception as e:
+        payload = None
+        DATA_ERROR_MESSAGE = f"ERRO AO CARREGAR DADOS: {e}"
+    return payload
 
 # --- 4. INICIALIZAÇÃO E LAYOUT DO APP ---
 app = dash.Dash(__name__)
 
-app.layout = html.Div(children=[
-    html.H1(children='Análise da Avifauna em Zonas de Influência Rodoviária próximas a Unidades de Conservação em Minas Gerais'),
-    html.Div(children=[html.P(DATA_ERROR_MESSAGE, style={'color': 'red', 'fontWeight': 'bold'})]),
+def map_layer_url(layer, band, bbox=None):
+    query = f"?bbox={','.join(str(v) for v in bbox)}" if bbox else ''
+    return app.get_relative_path(f'/mapa/{layer}/{band}.geojson') + query
+
+@app.server.route('/mapa/<layer>/<int:band>.geojson')
+def serve_map_layer(layer, band):
+    payload = current_dashboard()
+    map_layers = payload['map_layers'] if payload is not None else {}
+    if layer not in map_layers or band >= len(MAP_ZOOM_BANDS):
+        abort(404)
+    try:
+        bbox = tuple(float(v) for v in request.args['bbox'].split(',')) if 'bbox' in request.args else None
+    except ValueError:
+        abort(400)
+    if bbox is not None and len(bbox) != 4:
+        abort(400)
+    response = Response(map_layers[layer].geojson(band, bbox), mimetype='application/geo+json')
+    response.set_etag(map_layers[layer].etag(band, bbox))
+    response.cache_control.public = True
+    response.cache_control.max_age = MAP_CACHE_MAX_AGE
+    return response.make_conditional(request)
+
+def gbif_trace_data(occurrence_index, zoom, bbox=None):
+    """Pontos ou células agregadas das ocorrências em `bbox` para o traço do GBIF."""
+    s = STYLE_CONFIG['gbif']
+    indices = occurrence_index.query(bbox)
+    if zoom >= GBIF_POINTS_MIN_ZOOM and len(indices) <= GBIF_MAX_POINTS:
+        points = occurrence_index.points(indices)
+        return {'lat': points['lat'].tolist(), 'lon': points['lon'].tolist(),
+                'size': s['size'], 'hovertext': points['scientificName'].tolist()}
+    cells = occurrence_index.aggregate(indices, cell_size_for_zoom(zoom, GBIF_CELL_PIXELS))
+    return {
+        'lat': cells['lat'].tolist(), 'lon': cells['lon'].tolist(),
+        'size': np.minimum(s['size'] + 3 * np.log2(cells['n_registros'].to_numpy(float)), 30).tolist(),
+        'hovertext': [f'{n} registros, {r} espécies' for n, r in zip(cells['n_registros'], cells['riqueza_especies'])],
+    }
+
+def occurrence_years(payload):
+    """Primeiro e último ano com ocorrências datadas nas AEs/ADAs (limites do filtro de período)."""
+    ranges = [index.date_range() for index in payload['occurrence_periods'].values()] if payload else []
+    ranges = [r for r in ranges if r is not None]
+    if not ranges:
+        year = pd.Timestamp.now().year
+        return year, year
+    return (int(str(min(r[0] for r in ranges))[:4]), int(str(max(r[1] for r in ranges))[:4]))
+
+def taxon_options(payload):
+    """Opções do filtro de táxon: ordens e famílias presentes nas AEs ('nível|nome')."""
+    if payload is None:
+        return []
+    index = payload['occurrence_periods']['aes']
+    labels = {'order': 'Ordem', 'family': 'Família'}
+    return [{'label': f'{labels[level]}: {name}', 'value': f'{level}|{name}'}
+            for level in index.TAXON_LEVELS for name in index.taxon_names(level)]
+
+def indicator_table(payload, years=None, taxon=None, aes_ids=None, adas_ids=None):
+    """
+    Tabela de indicadores, apelidos e legenda de uso do solo para os cartões e
+    gráficos. Com filtro de período (anos) ou de táxon ('nível|nome'), os
+    indicadores de ocorrências vêm dos índices por feição. Com `aes_ids` ou
+    `adas_ids`, só essas feições entram (ver IndicatorLookup.table).
+    """
+    if payload is None:
+        return None
+    table = payload['indicator_lookup'].table(INDICATOR_CARDS, aes_ids, adas_ids)
+    first_year, last_year = occurrence_years(payload)
+    if years and (years[0] > first_year or years[1] < last_year):
+        start, end = f'{years[0]}-01-01', f'{years[1]}-12-31'
+    else:
+        start = end = None
+    taxon = tuple(taxon.split('|', 1)) if taxon else None
+    if start is not None or taxon is not None:
+        for layer in ['aes', 'adas']:
+            index = payload['occurrence_periods'][layer]
+            for feature_id, record in table[layer].items():
+                record.update(index.summary(feature_id, start, end, taxon))
+        totals = payload['occurrence_periods']['aes'].totals(start, end, taxon)
+        for column in OCCURRENCE_COLUMNS:
+            table['ae_sums'][column], table['ae_counts'][column] = totals[column], table['n_aes']
+    table.update({
+        'cards': INDICATOR_CARDS,
+        'aliases': COLUMN_ALIASES,
+        'land_use': {str(code): label for code, label in USO_SOLO_MAP.items()},
+        'template': pio.templates[pio.templates.default].to_plotly_json(),
+    })
+    return table
+
+def serve_layout():
+    # Montado a cada carregamento de página, com a figura do artefato atual
+    payload = current_dashboard()
+    figure = payload['figure'] if payload is not None else go.Figure()
+    first_year, last_year = occurrence_years(payload)
+    return html.Div(children=[
+        dcc.Store(id='tabela-indicadores', data=indicator_table(payload) if CLIENTSIDE_INDICATORS else None),
+        html.H1(children='Análise da Avifauna em Zonas de Influência Rodoviária próximas a Unidades de Conservação em Minas Gerais'),
+        html.Div(children=[html.P(DATA_ERROR_MESSAGE, style={'color': 'red', 'fontWeight': 'bold'})]),
     
-    html.Div(
-        style={'display': 'flex'},
-        children=[
-            html.Div(
-                dcc.Graph(id='mapa-principal', style={'height': '80vh'}),
-                style={'width': '50%', 'padding': '10px'}
-            ),
-            html.Div(
-                children=[
-                    html.H3(id='titulo-selecao', children='Selecione uma Área de Estudo ou ADA diretamente no mapa'),
-                    html.Div(
-                        id='indicator-grid',
-                        className='indicator-grid',
-                        children=[
-                            html.Div(id='indicator-card-1', className='indicator-card'),
-                            html.Div(id='indicator-card-2', className='indicator-card'),
-                            html.Div(id='indicator-card-3', className='indicator-card'),
-                            html.Div(id='indicator-card-4', className='indicator-card'),
-                            html.Div(id='indicator-card-5', className='indicator-card'),
-                            html.Div(id='indicator-card-6', className='indicator-card'),
-                            html.Div(id='indicator-card-7', className='indicator-card'),
-                            html.Div(id='indicator-card-8', className='indicator-card'),
-                            html.Div(id='indicator-card-9', className='indicator-card'),
-                            html.Div(id='indicator-card-10', className='indicator-card'),
-                        ]
-                    ),
-                    html.Hr(),
-                    dcc.Graph(id='grafico-comparativo-1'),
-                    dcc.Graph(id='grafico-comparativo-2')
-                ],
-                style={
-                    'width': '50%', 
-                    'padding': '10px',
-                    'display': 'flex',
-                    'flexDirection': 'column',
-                    'justifyContent': 'flex-start' 
-                }
-            )
-        ]
-    )
-])
+        html.Div(
+            style={'display': 'flex'},
+            children=[
+                html.Div(
+                    dcc.Graph(id='mapa-principal', figure=figure, style={'height': '80vh'}),
+                    style={'width': '50%', 'padding': '10px'}
+                ),
+                html.Div(
+                    children=[
+                        html.H3(id='titulo-selecao', children='Selecione uma Área de Estudo ou ADA diretamente no mapa'),
+                        html.Div(
+                            className='indicator-filters',
+                            children=[
+                                html.Label('Período das ocorrências'),
+                                dcc.RangeSlider(
+                                    id='filtro-periodo', min=first_year, max=last_year, step=1,
+                                    value=[first_year, last_year], allowCross=False,
+                                    marks={year: str(year) for year in range(first_year, last_year + 1, max((last_year - first_year) // 6, 1))},
+                                    tooltip={'placement': 'bottom'}
+                                ),
+                                html.Label('Ordem ou família'),
+                                dcc.Dropdown(id='filtro-taxon', options=taxon_options(payload), placeholder='Todas as ordens e famílias'),
+                            ]
+                        ),
+                        html.Div(
+                            id='indicator-grid',
+                            className='indicator-grid',
+                            children=[
+                                html.Div(id='indicator-card-1', className='indicator-card'),
+                                html.Div(id='indicator-card-2', className='indicator-card'),
+                                html.Div(id='indicator-card-3', className='indicator-card'),
+                                html.Div(id='indicator-card-4', className='indicator-card'),
+                                html.Div(id='indicator-card-5', className='indicator-card'),
+                                html.Div(id='indicator-card-6', className='indicator-card'),
+                                html.Div(id='indicator-card-7', className='indicator-card'),
+                                html.Div(id='indicator-card-8', className='indicator-card'),
+                                html.Div(id='indicator-card-9', className='indicator-card'),
+                                html.Div(id='indicator-card-10', className='indicator-card'),
+                            ]
+                        ),
+                        html.Hr(),
+                        dcc.Graph(id='grafico-comparativo-1'),
+                        dcc.Graph(id='grafico-comparativo-2')
+                    ],
+                    style={
+                        'width': '50%', 
+                        'padding': '10px',
+                        'display': 'flex',
+                        'flexDirection': 'column',
+                        'justifyContent': 'flex-start' 
+                    }
+                )
+            ]
+        )
+    ])
+
 
 # --- 5. CRIAÇÃO DA FIGURA DO MAPA ---
-fig = go.Figure()
+def create_map_figure(gdfs, occurrence_index):
+    fig = go.Figure()
 
-if not DATA_ERROR_MESSAGE:
-    gdf_mg = gdfs['mg_limits']
-    center_lat, center_lon = gdf_mg.geometry.union_all().centroid.y, gdf_mg.geometry.union_all().centroid.x
-    zoom_level = 6
+    gdf_mg = gdfs['mg_limits']; mg_union = gdf_mg.geometry.union_all()
+    center_lat, center_lon = mg_union.centroid.y, mg_union.centroid.x
 
-    s = STYLE_CONFIG['mg_limits']; mg_boundary = gdf_mg.geometry.union_all().boundary
+    s = STYLE_CONFIG['mg_limits']; mg_boundary = mg_union.boundary.simplify(MG_BOUNDARY_TOLERANCE)
     fig.add_trace(go.Scattermap(lat=[p[1] for p in mg_boundary.coords], lon=[p[0] for p in mg_boundary.coords], mode='lines', line=dict(width=s['width'], color=s['color']), name=s['name']))
 
-    s = STYLE_CONFIG['ucs']; fig.add_trace(go.Choroplethmap(
-        geojson=gdfs['ucs'].geometry.__geo_interface__, 
-        locations=gdfs['ucs'].index, 
-        z=[1]*len(gdfs['ucs']), 
-        colorscale=[[0, s['color']], [1, s['color']]], 
-        showscale=False, 
+    # Os polígonos das UCs são camadas do mapa (uma por faixa de zoom, lidas da
+    # rota /mapa); o traço guarda só um ponto por UC, para o nome no hover
+    s = STYLE_CONFIG['ucs']; uc_points = gdfs['ucs'].geometry.representative_point()
+    fig.add_trace(go.Scattermap(
+        lat=uc_points.y,
+        lon=uc_points.x,
+        mode='markers',
+        marker=dict(size=4, color=s['color']),
         name=s['name'],
         hovertext=gdfs['ucs']['nome_uc'],
         hovertemplate='<b>%{hovertext}</b><extra></extra>'
-    ))  
+    ))
+    uc_layers = [
+        dict(sourcetype='geojson', type='fill', color=s['color'], below='traces', minzoom=min_zoom, maxzoom=max_zoom,
+             source=map_layer_url('ucs', band) if band == 0 else {'type': 'FeatureCollection', 'features': []})
+        for band, (min_zoom, max_zoom, _) in enumerate(MAP_ZOOM_BANDS)
+    ]
       
-    s = STYLE_CONFIG['ae']; gdf_ae_indexed = gdfs['ae'].set_index('aes_id'); geojson_ae = json.loads(gdf_ae_indexed.to_json())
+    s = STYLE_CONFIG['ae']; gdf_ae_indexed = gdfs['ae'].set_index('aes_id'); geojson_ae = gdf_ae_indexed.__geo_interface__
     fig.add_trace(go.Choroplethmap(geojson=geojson_ae, locations=gdf_ae_indexed.index, featureidkey="id", z=[1]*len(gdf_ae_indexed), customdata=gdf_ae_indexed.index, colorscale=[[0, s['color']], [1, s['color']]], showscale=False, marker_line_width=s['line_width'], marker_line_color=s['line_color'], name=s['name']))
 
-    s = STYLE_CONFIG['ada']; gdf_ada_indexed = gdfs['ada'].set_index('adas_id'); geojson_ada = json.loads(gdf_ada_indexed.to_json())
+    s = STYLE_CONFIG['ada']; gdf_ada_indexed = gdfs['ada'].set_index('adas_id'); geojson_ada = gdf_ada_indexed.__geo_interface__
     fig.add_trace(go.Choroplethmap(geojson=geojson_ada, locations=gdf_ada_indexed.index, featureidkey="id", z=[1]*len(gdf_ada_indexed), customdata=gdf_ada_indexed.index, colorscale=[[0, s['color']], [1, s['color']]], showscale=False, marker_line_width=s['line_width'], marker_line_color=s['line_color'], name=s['name']))
 
-    s = STYLE_CONFIG['gbif']; fig.add_trace(go.Scattermap(lat=gdfs['gbif'].geometry.y, lon=gdfs['gbif'].geometry.x, mode='markers', marker=dict(size=s['size'], color=s['color'], opacity=s['opacity']), name=s['name'], hovertext=gdfs['gbif']['scientificName']))
+    # Ocorrências agregadas no zoom inicial; o callback do mapa troca pelos
+    # dados da área visível a cada movimento
+    s = STYLE_CONFIG['gbif']; gbif = gbif_trace_data(occurrence_index, MAP_ZOOM)
+    fig.add_trace(go.Scattermap(lat=gbif['lat'], lon=gbif['lon'], mode='markers', marker=dict(size=gbif['size'], color=s['color'], opacity=s['opacity']), name=s['name'], hovertext=gbif['hovertext']))
 
     fig.update_layout(
-        mapbox_style="open-street-map", mapbox_zoom=zoom_level,
-        mapbox_center={"lat": center_lon, "lon": center_lon},
+        map_style="open-street-map", map_zoom=MAP_ZOOM,
+        map_center={"lat": center_lat, "lon": center_lon},
+        map_layers=uc_layers,
+        uirevision='mapa',
         margin={"r":0,"t":0,"l":0,"b":0},
         legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01)
     )
+    return fig
 
-app.layout.children[2].children[0].children.figure = fig
+# Carrega (ou monta, na primeira execução) o artefato na inicialização. O
+# layout só é atribuído aqui porque o Dash já chama a função na atribuição,
+# e a montagem do artefato depende de create_map_figure
+current_dashboard()
+app.layout = serve_layout
 
-# --- 6. CALLBACK
+# --- 6. CALLBACKS
 @app.callback(
-    [
-        Output('titulo-selecao', 'children'),
-        Output('indicator-card-1', 'children'),
-        Output('indicator-card-2', 'children'),
-        Output('indicator-card-3', 'children'),
-        Output('indicator-card-4', 'children'),
-        Output('indicator-card-5', 'children'),
-        Output('indicator-card-6', 'children'),
-        Output('indicator-card-7', 'children'),
-        Output('indicator-card-8', 'children'),
-        Output('indicator-card-9', 'children'),
-        Output('indicator-card-10', 'children'),
-        Output('grafico-comparativo-1', 'figure'),
-        Output('grafico-comparativo-2', 'figure')
-    ],
-    [Input('mapa-principal', 'clickData')]
+    Output('mapa-principal', 'figure'),
+    Input('mapa-principal', 'relayoutData'),
+    prevent_initial_call=True
 )
-def update_on_click(clickData):
+def update_map_viewport(relayoutData):
+    # Área visível ajustada à grade de blocos do zoom (URLs e células repetíveis)
+    relayoutData = relayoutData or {}
+    zoom, derived = relayoutData.get('map.zoom'), relayoutData.get('map._derived')
+    if zoom is None or derived is None:
+        return no_update
+    payload = current_dashboard()
+    if payload is None:
+        return no_update
+    map_layers, occurrence_index = payload['map_layers'], payload['occurrence_index']
+    lons, lats = zip(*derived['coordinates'])
+    bbox = snap_bbox((min(lons), min(lats), max(lons), max(lats)), zoom)
+    patched = Patch()
+
+    # A camada de UCs da faixa de zoom atual passa a pedir só a área visível;
+    # a faixa mais grosseira já é carregada inteira
+    band = band_for_zoom(MAP_ZOOM_BANDS, zoom)
+    if 'ucs' in map_layers and band > 0:
+        patched['layout']['map']['layers'][band]['source'] = map_layer_url('ucs', band, bbox)
+
+    # Traço do GBIF (índice 4): células agregadas ou pontos da área visível
+    if occurrence_index is not None:
+        gbif = gbif_trace_data(occurrence_index, zoom, bbox)
+        patched['data'][4]['lat'] = gbif['lat']
+        patched['data'][4]['lon'] = gbif['lon']
+        patched['data'][4]['marker']['size'] = gbif['size']
+        patched['data'][4]['hovertext'] = gbif['hovertext']
+    return patched
+
+# Versão no servidor do callback de clique (usada se CLIENTSIDE_INDICATORS = False;
+# a versão no navegador está em assets/painel.js)
+def mean_of_other_aes(table, aes_id, column):
+    """Média de `column` entre as AEs diferentes de `aes_id`, pelas somas da tabela de indicadores."""
+    total, count = table['ae_sums'][column] or 0, table['ae_counts'][column] or 0
+    value = table['aes'].get(str(aes_id), {}).get(column)
+    if value is not None:
+        total -= value
+        count -= 1
+    return total / count if count else None
+
+def update_on_click(clickData, years=None, taxon=None):
     if not clickData:
         empty_cards = [""] * 10
         empty_figs = [go.Figure(), go.Figure()]
         return ["Selecione uma Área de Estudo ou ADA diretamente no mapa"] + empty_cards + empty_figs
 
-    curve_index = clickData['points'][0]['curveNumber']
-    clicked_id = clickData['points'][0]['customdata']
+    # Pontos do contorno de MG e das UCs não têm customdata
+    point = clickData['points'][0]
+    curve_index = point.get('curveNumber')
+    clicked_id = point.get('customdata') if curve_index in (2, 3) else None
+    if clicked_id is None:
+        table = record = None
+    else:
+        # Tabela só da feição clicada (e da AE pai, se for ADA)
+        layer = 'aes' if curve_index == 2 else 'adas'
+        ids = {'aes_ids': [clicked_id], 'adas_ids': []} if layer == 'aes' else {'aes_ids': [], 'adas_ids': [clicked_id]}
+        table = indicator_table(current_dashboard(), years, taxon, **ids)
+        record = table[layer].get(str(clicked_id)) if table is not None else None
+    if record is None:
+        empty_cards = [""] * 10
+        empty_figs = [go.Figure(), go.Figure()]
+        return ["Selecione uma Área de Estudo ou ADA diretamente no mapa"] + empty_cards + empty_figs
 
-    indicator_order = [
-        'area_ha', 'riqueza_especies', 'n_registros', 'n_individuos', 'dist_uc_km',
-        'n_ucs_raio_5km', 'elevacao_media', 'relevo_m', 'uso_solo_1', 'uso_solo_2'
-    ]
-    
     fig1 = go.Figure()
     fig2 = go.Figure()
 
     if curve_index == 2: # AE clicada
-        all_aes = gpd.read_file(DATA_GPKG, layer=LAYER_NAMES['ae'])
-        dff = all_aes[all_aes['aes_id'] == clicked_id]
-        other_aes_mean = all_aes[all_aes['aes_id'] != clicked_id][indicator_order].mean(numeric_only=True)
+        dff = record
+        other_aes_mean = {col: mean_of_other_aes(table, clicked_id, col)
+                          for col in ['riqueza_especies', 'n_ucs_raio_5km']}
         
-        fig1.add_trace(go.Bar(name='AE Selecionada', x=['Riqueza de Espécies'], y=dff['riqueza_especies']))
-        fig1.add_trace(go.Bar(name='Média das Outras AEs', x=['Riqueza de Espécies'], y=other_aes_mean[['riqueza_especies']]))
+        fig1.add_trace(go.Bar(name='AE Selecionada', x=['Riqueza de Espécies'], y=[dff.get('riqueza_especies')]))
+        fig1.add_trace(go.Bar(name='Média das Outras AEs', x=['Riqueza de Espécies'], y=[other_aes_mean['riqueza_especies']]))
         fig1.update_layout(title_text='Riqueza de Espécies: Área de Estudo selecionada vs Média das outras Áreas de Estudo')
 
-        fig2.add_trace(go.Bar(name='AE Selecionada', x=['Nº de UCs no raio'], y=dff['n_ucs_raio_5km']))
-        fig2.add_trace(go.Bar(name='Média das Outras AEs', x=['Nº de UCs no raio'], y=other_aes_mean[['n_ucs_raio_5km']]))
+        fig2.add_trace(go.Bar(name='AE Selecionada', x=['Nº de UCs no raio'], y=[dff.get('n_ucs_raio_5km')]))
+        fig2.add_trace(go.Bar(name='Média das Outras AEs', x=['Nº de UCs no raio'], y=[other_aes_mean['n_ucs_raio_5km']]))
         fig2.update_layout(title_text='Nº de UCs no raio de 5km: Área de Estudo selecionada vs Média das outras Áreas de Estudo')
         
         title_prefix = "AE"
 
     elif curve_index == 3: # ADA clicada
-        all_adas = gpd.read_file(DATA_GPKG, layer=LAYER_NAMES['ada'])
-        dff = all_adas[all_adas['adas_id'] == clicked_id]
-        parent_ae_id = dff['aes_id'].iloc[0]
-        all_aes = gpd.read_file(DATA_GPKG, layer=LAYER_NAMES['ae'])
-        parent_ae_df = all_aes[all_aes['aes_id'] == parent_ae_id]
+        dff = record
+        parent_ae_df = table['aes'].get(table['parent'].get(str(clicked_id))) or {}
         
-        fig1.add_trace(go.Bar(name='ADA Selecionada', x=['Riqueza de Espécies'], y=dff['riqueza_especies']))
-        fig1.add_trace(go.Bar(name='AE Pai', x=['Riqueza de Espécies'], y=parent_ae_df['riqueza_especies']))
+        fig1.add_trace(go.Bar(name='ADA Selecionada', x=['Riqueza de Espécies'], y=[dff.get('riqueza_especies')]))
+        fig1.add_trace(go.Bar(name='AE Pai', x=['Riqueza de Espécies'], y=[parent_ae_df.get('riqueza_especies')]))
         fig1.update_layout(title_text='Riqueza de Espécies: Área Diretamente Afetada vs Área de Estudo pertencente')
 
-        fig2.add_trace(go.Bar(name='ADA Selecionada', x=['Nº de UCs no Raio'], y=dff['n_ucs_raio_5km']))
-        fig2.add_trace(go.Bar(name='AE Pai', x=['Nº de UCs no Raio'], y=parent_ae_df['n_ucs_raio_5km']))
+        fig2.add_trace(go.Bar(name='ADA Selecionada', x=['Nº de UCs no Raio'], y=[dff.get('n_ucs_raio_5km')]))
+        fig2.add_trace(go.Bar(name='AE Pai', x=['Nº de UCs no Raio'], y=[parent_ae_df.get('n_ucs_raio_5km')]))
         fig2.update_layout(title_text='Nº de UCs no Raio de 5km: Área Diretamente Afetada vs Área de Estudo pertencente')
 
         title_prefix = "ADA"
@@ -263,17 +511,40 @@ def update_on_click(clickData):
         return ["Selecione uma Área de Estudo ou ADA diretamente no mapa"] + empty_cards + empty_figs
         
     def create_card(column_id):
-        value = dff[column_id].iloc[0]
+        value = dff.get(column_id)
         if column_id in ['uso_solo_1', 'uso_solo_2']:
             value = USO_SOLO_MAP.get(value, 'Desconhecido')
         return html.Div([html.H5(COLUMN_ALIASES.get(column_id, column_id)), html.P(value)])
     
-    outputs = [create_card(col) for col in indicator_order]
+    outputs = [create_card(col) for col in INDICATOR_CARDS]
 
     final_return = [f"Atributos para a {title_prefix}: {clicked_id}"] + outputs + [fig1, fig2]
     
     return tuple(final_return)
 
+CLICK_OUTPUTS = [
+    Output('titulo-selecao', 'children'),
+    *[Output(f'indicator-card-{i}', 'children') for i in range(1, 11)],
+    Output('grafico-comparativo-1', 'figure'),
+    Output('grafico-comparativo-2', 'figure'),
+]
+FILTER_INPUTS = [Input('filtro-periodo', 'value'), Input('filtro-taxon', 'value')]
+if CLIENTSIDE_INDICATORS:
+    # Os filtros recalculam a tabela no servidor (uma vez por mudança de filtro);
+    # cartões e gráficos são refeitos no navegador
+    @app.callback(Output('tabela-indicadores', 'data'), FILTER_INPUTS, prevent_initial_call=True)
+    def update_indicator_table(years, taxon):
+        return indicator_table(current_dashboard(), years, taxon)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='painel', function_name='updateOnClick'),
+        CLICK_OUTPUTS,
+        Input('mapa-principal', 'clickData'),
+        Input('tabela-indicadores', 'data'),
+    )
+else:
+    app.callback(CLICK_OUTPUTS, [Input('mapa-principal', 'clickData')] + FILTER_INPUTS)(update_on_click)
+
 #7. EXECUTAR O SERVIDOR
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,115 @@
+import pandas as pd
+import threading
+import glob
+import time
+import os
+
+# Artefato pré-montado do painel: tudo o que o app serve (figura do mapa,
+# tabela de indicadores, índices do mapa) é montado uma vez e guardado em
+# disco como pickle, com a versão dos dados no nome. Um processo novo carrega
+# o artefato direto, sem ler nem reprojetar camadas; quando os dados mudam,
+# a versão nova é montada em segundo plano e o artefato antigo continua sendo
+# servido até ela ficar pronta.
+
+# Idade (s) a partir da qual a trava de montagem de outro processo é ignorada
+STALE_LOCK_S = 3600
+
+
+class DashboardArtifact:
+    """
+    Artefato em `directory`. `version_fn()` devolve a versão atual dos dados
+    (texto curto, barato de calcular) e `build_fn()` monta o conteúdo (um
+    dicionário). A versão é verificada no máximo a cada `check_interval_s`
+    segundos. Só um processo por vez monta cada versão (arquivo de trava); os
+    demais passam a usá-la quando o arquivo aparece.
+    """
+
+    def __init__(self, directory, version_fn, build_fn, check_interval_s=30.0, name='painel'):
+        self.directory = directory
+        self.version_fn = version_fn
+        self.build_fn = build_fn
+        self.check_interval_s = check_interval_s
+        self.name = name
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._version = None
+        self._payload = None
+        self._building = None
+
+    def _path(self, version):
+        return os.path.join(self.directory, f'{self.name}.{version}.pkl')
+
+    def _latest(self):
+        paths = glob.glob(os.path.join(glob.escape(self.directory), f'{glob.escape(self.name)}.*.pkl'))
+        if not paths:
+            return None, None
+        path = max(paths, key=os.path.getmtime)
+        return os.path.basename(path)[len(self.name) + 1:-len('.pkl')], pd.read_pickle(path)
+
+    def _build(self, version):
+        """Monta e salva o artefato da versão; devolve None se outro processo já o está montando."""
+        os.makedirs(self.directory, exist_ok=True)
+        lock_path = f'{self._path(version)}.lock'
+        if os.path.exists(lock_path) and time.time() - os.path.getmtime(lock_path) > STALE_LOCK_S:
+            os.remove(lock_path)
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return None
+        try:
+            print(f"Artefato do painel: montando a versão {version}...")
+            payload = self.build_fn()
+            tmp_path = f'{self._path(version)}.{os.getpid()}.tmp'
+            pd.to_pickle(payload, tmp_path)
+            os.replace(tmp_path, self._path(version))
+            for stale in glob.glob(os.path.join(glob.escape(self.directory), f'{glob.escape(self.name)}.*.pkl')):
+                if stale != self._path(version):
+                    os.remove(stale)
+            return payload
+        finally:
+            os.remove(lock_path)
+
+    def _build_in_background(self, version):
+        def run():
+            try:
+                payload = self._build(version)
+            except Exception as e:
+                print(f"Artefato do painel: erro ao montar a versão {version}: {e}")
+                payload = None
+            with self._lock:
+                if payload is not None:
+                    self._version, self._payload = version, payload
+                self._building = None
+
+        self._building = version
+        threading.Thread(target=run, daemon=True).start()
+
+    def current(self):
+        """Conteúdo do artefato (o mais recente disponível; None se ainda não existe nenhum)."""
+        now = time.monotonic()
+        if self._payload is not None and now - self._checked_at < self.check_interval_s:
+            return self._payload
+        with self._lock:
+            self._checked_at = now
+            try:
+                version = self.version_fn()
+            except Exception as e:
+                if self._payload is None:
+                    raise
+                print(f"Artefato do painel: versão dos dados indisponível ({e}); mantendo a atual.")
+                return self._payload
+            if version == self._version:
+                return self._payload
+
+            if os.path.exists(self._path(version)):
+                self._version, self._payload = version, pd.read_pickle(self._path(version))
+                return self._payload
+            if self._payload is None:
+                self._version, self._payload = self._latest()
+            if self._payload is None:
+                # Nenhum artefato em disco: a primeira montagem é feita agora
+                payload = self._build(version)
+                self._version, self._payload = (version, payload) if payload is not None else (None, None)
+            elif self._building != version:
+                self._build_in_background(version)
+            return self._payload
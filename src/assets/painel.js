@@ -0,0 +1,100 @@
+// Callback de clique no mapa executado no navegador: título, cartões e
+// gráficos comparativos montados a partir da tabela de indicadores
+// (dcc.Store 'tabela-indicadores', refeita no servidor só quando os filtros
+// de período/táxon mudam), sem ida ao servidor. Espelha update_on_click em
+// 05_app.py.
+
+(function () {
+    var EMPTY_TITLE = 'Selecione uma Área de Estudo ou ADA diretamente no mapa';
+    var LAND_USE_COLUMNS = ['uso_solo_1', 'uso_solo_2'];
+
+    function component(type, children) {
+        return {type: type, namespace: 'dash_html_components', props: {children: children}};
+    }
+
+    function figure(table, traces, title) {
+        var layout = {template: table ? table.template : undefined};
+        if (title) {
+            layout.title = {text: title};
+        }
+        return {data: traces || [], layout: layout};
+    }
+
+    function bar(name, x, y) {
+        return {type: 'bar', name: name, x: [x], y: [y === undefined ? null : y]};
+    }
+
+    function emptyOutputs(table) {
+        var cards = [];
+        for (var i = 0; i < 10; i++) {
+            cards.push('');
+        }
+        return [EMPTY_TITLE].concat(cards, [figure(table), figure(table)]);
+    }
+
+    // Média de `column` entre as AEs diferentes de `aesId` (como mean_of_other_aes)
+    function meanOfOtherAes(table, aesId, column) {
+        var total = table.ae_sums[column] || 0;
+        var count = table.ae_counts[column] || 0;
+        var value = (table.aes[aesId] || {})[column];
+        if (value !== null && value !== undefined) {
+            total -= value;
+            count -= 1;
+        }
+        return count ? total / count : null;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        painel: {
+            updateOnClick: function (clickData, table) {
+                if (!clickData || !table) {
+                    return emptyOutputs(table);
+                }
+                var point = clickData.points[0];
+                var curveIndex = point.curveNumber;
+                var clickedId = String(point.customdata);
+                var record = curveIndex === 2 ? table.aes[clickedId] : curveIndex === 3 ? table.adas[clickedId] : null;
+                if (!record) {
+                    return emptyOutputs(table);
+                }
+
+                var fig1, fig2, titlePrefix;
+                if (curveIndex === 2) { // AE clicada
+                    fig1 = figure(table, [
+                        bar('AE Selecionada', 'Riqueza de Espécies', record.riqueza_especies),
+                        bar('Média das Outras AEs', 'Riqueza de Espécies', meanOfOtherAes(table, clickedId, 'riqueza_especies'))
+                    ], 'Riqueza de Espécies: Área de Estudo selecionada vs Média das outras Áreas de Estudo');
+                    fig2 = figure(table, [
+                        bar('AE Selecionada', 'Nº de UCs no raio', record.n_ucs_raio_5km),
+                        bar('Média das Outras AEs', 'Nº de UCs no raio', meanOfOtherAes(table, clickedId, 'n_ucs_raio_5km'))
+                    ], 'Nº de UCs no raio de 5km: Área de Estudo selecionada vs Média das outras Áreas de Estudo');
+                    titlePrefix = 'AE';
+                } else { // ADA clicada
+                    var parent = table.aes[table.parent[clickedId]] || {};
+                    fig1 = figure(table, [
+                        bar('ADA Selecionada', 'Riqueza de Espécies', record.riqueza_especies),
+                        bar('AE Pai', 'Riqueza de Espécies', parent.riqueza_especies)
+                    ], 'Riqueza de Espécies: Área Diretamente Afetada vs Área de Estudo pertencente');
+                    fig2 = figure(table, [
+                        bar('ADA Selecionada', 'Nº de UCs no Raio', record.n_ucs_raio_5km),
+                        bar('AE Pai', 'Nº de UCs no Raio', parent.n_ucs_raio_5km)
+                    ], 'Nº de UCs no Raio de 5km: Área Diretamente Afetada vs Área de Estudo pertencente');
+                    titlePrefix = 'ADA';
+                }
+
+                var cards = table.cards.map(function (column) {
+                    var value = record[column];
+                    if (LAND_USE_COLUMNS.indexOf(column) >= 0) {
+                        value = table.land_use[String(value)] || 'Desconhecido';
+                    }
+                    return component('Div', [
+                        component('H5', table.aliases[column] || column),
+                        component('P', value === undefined ? null : value)
+                    ]);
+                });
+
+                return ['Atributos para a ' + titlePrefix + ': ' + clickedId].concat(cards, [fig1, fig2]);
+            }
+        }
+    });
+})();
@@ -0,0 +1,108 @@
+import geopandas as gpd
+import hashlib
+import sqlite3
+import threading
+import glob
+import json
+import os
+from contextlib import closing
+from pyproj import CRS
+from camadas import layer_version
+
+# Cache em disco de camadas derivadas (reprojetadas, dissolvidas) das camadas
+# de base do GeoPackage, compartilhado entre os scripts. Cada entrada é
+# endereçada pelo conteúdo: checksum da camada de origem + operação + CRS de
+# destino; se a camada de origem muda, a chave muda e a entrada é refeita.
+# As entradas são GeoPackages com índice R-tree, de modo que quem só precisa
+# do entorno de algumas geometrias lê apenas as feições dentro da máscara.
+# As camadas derivadas mantêm o fid da origem como índice.
+
+# Versão do formato das entradas (entra na chave)
+CACHE_FORMAT = 3
+
+OPERATIONS = {
+    'project': lambda gdf, crs: gdf.to_crs(crs),
+    'dissolve': lambda gdf, crs: gpd.GeoDataFrame(geometry=[gdf.to_crs(crs).union_all()], crs=crs),
+}
+
+
+def layer_checksum(path, layer):
+    """
+    SHA-256 do conteúdo de uma camada do GeoPackage (todas as linhas, em
+    ordem de fid), lido direto do SQLite, sem decodificar as geometrias.
+    """
+    h = hashlib.sha256(layer.encode())
+    with closing(sqlite3.connect(path)) as con:
+        for row in con.execute(f'SELECT * FROM "{layer}" ORDER BY rowid'):
+            for value in row:
+                data = value if isinstance(value, bytes) else repr(value).encode()
+                h.update(len(data).to_bytes(8, 'little'))
+                h.update(data)
+    return h.hexdigest()
+
+
+class DerivedLayerCache:
+    """
+    Camadas derivadas das camadas de `gpkg_path`, guardadas em `cache_dir`
+    como GeoPackages. `get` devolve a camada do cache (opcionalmente só as
+    feições que intersectam `mask`) ou a calcula, salva e remove as versões
+    antigas da mesma derivação.
+    """
+
+    def __init__(self, gpkg_path, cache_dir):
+        self.gpkg_path = gpkg_path
+        self.cache_dir = cache_dir
+        self._checksums = {}
+        self._lock = threading.Lock()
+
+    def checksum(self, layer):
+        """
+        Checksum da camada de origem. Fica guardado em disco junto com a
+        versão barata da camada (layer_version) e só é recalculado quando
+        ela muda; dentro da instância, é lido uma vez.
+        """
+        with self._lock:
+            if layer not in self._checksums:
+                self._checksums[layer] = self._stored_checksum(layer)
+            return self._checksums[layer]
+
+    def _stored_checksum(self, layer):
+        memo_path = os.path.join(self.cache_dir, 'checksums.json')
+        memo = {}
+        if os.path.exists(memo_path):
+            with open(memo_path) as f:
+                memo = json.load(f)
+        memo_key = f'{os.path.abspath(self.gpkg_path)}|{layer}'
+        version = layer_version(self.gpkg_path, layer)
+        entry = memo.get(memo_key)
+        if entry and entry[0] == version:
+            return entry[1]
+        checksum = layer_checksum(self.gpkg_path, layer)
+        memo[memo_key] = [version, checksum]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{memo_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp_path, memo_path)
+        return checksum
+
+    def get(self, layer, operation, crs, mask=None):
+        crs_name = CRS.from_user_input(crs).to_string()
+        key = hashlib.sha256(f'{self.checksum(layer)}|{operation}|{crs_name}|{CACHE_FORMAT}'.encode()).hexdigest()[:16]
+        prefix = os.path.join(self.cache_dir, f"{layer}.{operation}.{crs_name.replace(':', '_')}")
+        cache_path = f'{prefix}.{key}.gpkg'
+        if not os.path.exists(cache_path):
+            self._build(layer, operation, crs_name, prefix, cache_path)
+        # O filtro espacial usa o índice R-tree da entrada
+        return gpd.read_file(cache_path, mask=mask, fid_as_index=True)
+
+    def _build(self, layer, operation, crs_name, prefix, cache_path):
+        print(f"Cache de camadas: calculando '{layer}' ({operation}, {crs_name})...")
+        gdf = OPERATIONS[operation](gpd.read_file(self.gpkg_path, layer=layer, fid_as_index=True), crs_name)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{prefix}.{os.getpid()}.tmp.gpkg'
+        gdf.rename_axis('fid').reset_index().to_file(tmp_path, driver='GPKG', layer=layer)
+        os.replace(tmp_path, cache_path)
+        for stale in glob.glob(f'{glob.escape(prefix)}.*.gpkg') + glob.glob(f'{glob.escape(prefix)}.*.pkl'):
+            if stale != cache_path and not stale.endswith('.tmp.gpkg'):
+                os.remove(stale)
@@ -0,0 +1,266 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+import sqlite3
+import struct
+import os
+from contextlib import closing
+
+# Leitura e escrita de camadas do GeoPackage. As leituras aplicam o filtro
+# espacial no próprio leitor (pyogrio + índice R-tree do GPKG), para não
+# decodificar feições estaduais que serão descartadas logo em seguida; as
+# escritas alteram apenas as linhas necessárias.
+
+# Origem das leituras: 'gpkg' lê direto do GeoPackage; 'parquet' lê da réplica
+# colunar em GeoParquet (camadas_parquet, requer pyarrow), que é atualizada
+# automaticamente quando a camada muda no GeoPackage. As gravações são
+# sempre feitas no GeoPackage.
+STORAGE_BACKEND = 'gpkg'
+
+
+def read_layer(path, layer, columns=None, bbox=None, mask=None, fid_as_index=False):
+    """
+    Lê uma camada, opcionalmente só com as colunas `columns` (além da
+    geometria) e só com as feições que intersectam `bbox` ou `mask`.
+    """
+    if STORAGE_BACKEND == 'parquet':
+        from camadas_parquet import ParquetReplica  # pyarrow só é necessário com este backend
+        return ParquetReplica(path).read(layer, columns, bbox, mask, fid_as_index)
+    return gpd.read_file(path, layer=layer, columns=columns, bbox=bbox, mask=mask, fid_as_index=fid_as_index)
+
+
+def read_layer_near(path, layer, geometries, distance_m=0, crs_projected='EPSG:5880', columns=None):
+    """
+    Lê apenas as feições de `layer` que intersectam `geometries` expandidas
+    por `distance_m` metros. O buffer é feito em `crs_projected` e a máscara
+    é reprojetada para o CRS da camada.
+    """
+    extent = geometries.to_crs(crs_projected)
+    if distance_m:
+        extent = extent.buffer(distance_m)
+    mask = gpd.GeoSeries([extent.union_all()], crs=crs_projected)
+    return read_layer(path, layer, columns=columns, mask=mask)
+
+
+def layer_exists(path, layer):
+    """Verifica se o arquivo existe e contém a camada `layer`."""
+    return os.path.exists(path) and layer in pyogrio.list_layers(path)[:, 0]
+
+
+def layer_version(path, layer):
+    """
+    Versão barata de uma camada do GPKG: data da última alteração, nº de
+    feições e maior fid. Muda a cada gravação feita pelo GDAL ou pelas
+    funções deste módulo (inserções, remoções e update_layers).
+    """
+    with closing(sqlite3.connect(path)) as con:
+        last_change = con.execute(
+            'SELECT last_change FROM gpkg_contents WHERE table_name = ?', (layer,)
+        ).fetchone()
+        count, max_fid = con.execute(f'SELECT COUNT(*), MAX(rowid) FROM "{layer}"').fetchone()
+    return [last_change[0] if last_change else None, count, max_fid]
+
+
+def _native_values(values):
+    """
+    Converte escalares numpy (np.int64, np.float64...) nos tipos nativos do
+    Python antes de passá-los ao sqlite3, que grava um np.int64 como BLOB:
+    o valor nunca é igual ao inteiro armazenado na camada e a consulta não
+    encontra nenhuma linha.
+    """
+    return [v.item() if isinstance(v, np.generic) else v for v in values]
+
+
+def delete_rows(path, layer, column, values):
+    """
+    Remove de uma camada do GeoPackage as linhas cujo `column` está em
+    `values`. O GPKG é um banco SQLite, e as triggers de exclusão do índice
+    R-tree não dependem de funções espaciais, então o DELETE é feito direto.
+    Retorna o número de linhas removidas.
+    """
+    values = _native_values(values)
+    if not values or not layer_exists(path, layer):
+        return 0
+    with closing(sqlite3.connect(path)) as con, con:
+        con.execute("CREATE TEMP TABLE _delete_keys (value)")
+        con.executemany("INSERT INTO _delete_keys VALUES (?)", [(v,) for v in values])
+        cur = con.execute(f'DELETE FROM "{layer}" WHERE "{column}" IN (SELECT value FROM _delete_keys)')
+        return cur.rowcount
+
+
+def upsert_layer(path, layer, gdf, key):
+    """
+    Insere ou atualiza as feições de `gdf` na camada, usando `key` como
+    chave. As novas linhas são anexadas primeiro e só então as versões
+    antigas das mesmas chaves são removidas, de modo que uma falha no meio
+    do caminho nunca perde registros. Retorna (inseridas, substituídas).
+    """
+    if not layer_exists(path, layer):
+        gdf.to_file(path, layer=layer, driver='GPKG')
+        return len(gdf), 0
+
+    fid_column = pyogrio.read_info(path, layer=layer)['fid_column'] or 'fid'
+    with closing(sqlite3.connect(path)) as con:
+        last_fid = con.execute(f'SELECT COALESCE(MAX("{fid_column}"), 0) FROM "{layer}"').fetchone()[0]
+
+    gdf.to_file(path, layer=layer, driver='GPKG', mode='a')
+
+    keys = _native_values(gdf[key].unique())
+    with closing(sqlite3.connect(path)) as con, con:
+        con.execute("CREATE TEMP TABLE _upsert_keys (value)")
+        con.executemany("INSERT INTO _upsert_keys VALUES (?)", [(v,) for v in keys])
+        cur = con.execute(
+            f'DELETE FROM "{layer}" WHERE "{fid_column}" <= ? '
+            f'AND "{key}" IN (SELECT value FROM _upsert_keys)', (last_fid,)
+        )
+        replaced = cur.rowcount
+    return len(gdf) - replaced, replaced
+
+
+def deduplicate_layer(path, layer, key):
+    """
+    Mantém apenas a primeira linha (menor fid) de cada valor de `key`.
+    Retorna o número de linhas removidas.
+    """
+    if not layer_exists(path, layer):
+        return 0
+    fid_column = pyogrio.read_info(path, layer=layer)['fid_column'] or 'fid'
+    with closing(sqlite3.connect(path)) as con, con:
+        cur = con.execute(
+            f'DELETE FROM "{layer}" WHERE "{fid_column}" NOT IN '
+            f'(SELECT MIN("{fid_column}") FROM "{layer}" GROUP BY "{key}")'
+        )
+        return cur.rowcount
+
+
+def read_table(path, layer):
+    """Lê uma tabela sem geometria do GeoPackage (None se não existir)."""
+    if not layer_exists(path, layer):
+        return None
+    return pyogrio.read_dataframe(path, layer=layer, read_geometry=False)
+
+
+def write_table(df, path, layer):
+    """Grava (substituindo) uma tabela sem geometria no GeoPackage."""
+    pyogrio.write_dataframe(df, path, layer=layer, driver='GPKG')
+
+
+# Tamanho do envelope no cabeçalho do blob GPKG, por código de envelope
+_GPKG_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+def _gpkg_blob_to_wkb(blob):
+    """WKB de um blob de geometria do GPKG (None se nulo ou vazio)."""
+    if blob is None:
+        return None
+    flags = blob[3]
+    if (flags >> 4) & 1:
+        return None
+    return bytes(blob[8 + _GPKG_ENVELOPE_SIZES[(flags >> 1) & 7]:])
+
+
+def _geometry_to_gpkg_blob(geom, srs_id):
+    """Codifica uma geometria shapely no formato binário do GPKG (com envelope XY)."""
+    if geom is None:
+        return None
+    if geom.is_empty:
+        return b'GP' + bytes([0, 0b10001]) + struct.pack('<i', srs_id) + shapely.to_wkb(geom, byte_order=1)
+    minx, miny, maxx, maxy = geom.bounds
+    header = b'GP' + bytes([0, 0b00011]) + struct.pack('<i4d', srs_id, minx, maxx, miny, maxy)
+    return header + shapely.to_wkb(geom, byte_order=1)
+
+
+def _register_gpkg_functions(con):
+    """
+    Registra as funções ST_* usadas pelas triggers do índice R-tree criadas
+    pelo GDAL. O SQLite compila as triggers de UPDATE em qualquer alteração
+    da tabela, mesmo que só atributos mudem.
+    """
+    def envelope(i):
+        def func(blob):
+            wkb = _gpkg_blob_to_wkb(blob)
+            return None if wkb is None else shapely.bounds(shapely.from_wkb(wkb))[i]
+        return func
+
+    con.create_function('ST_IsEmpty', 1, lambda blob: int(_gpkg_blob_to_wkb(blob) is None), deterministic=True)
+    for name, i in [('ST_MinX', 0), ('ST_MinY', 1), ('ST_MaxX', 2), ('ST_MaxY', 3)]:
+        con.create_function(name, 1, envelope(i), deterministic=True)
+
+
+def _sql_type(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'DATETIME'
+    return 'TEXT'
+
+
+def _sql_values(series):
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        series = series.dt.strftime('%Y-%m-%dT%H:%M:%S')
+    return _native_values(series.astype(object).where(series.notna(), None))
+
+
+def update_layers(path, updates):
+    """
+    Atualiza no próprio GeoPackage as camadas de `updates`
+    ({camada: (gdf, coluna chave)}), sem reescrever o arquivo nem as demais
+    camadas. Colunas novas são adicionadas, colunas ausentes de `gdf` são
+    removidas e os valores são gravados por chave; geometrias só são
+    regravadas onde diferem das armazenadas. Tudo ocorre em uma única
+    transação: se algo falhar, as camadas anteriores ficam intactas.
+    Só atualiza feições existentes (as chaves de `gdf` devem estar na camada).
+    """
+    infos = {layer: pyogrio.read_info(path, layer=layer) for layer in updates}
+    with closing(sqlite3.connect(path, isolation_level=None)) as con:
+        _register_gpkg_functions(con)
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            for layer, (gdf, key) in updates.items():
+                _update_layer(con, layer, gdf, key, infos[layer])
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+
+
+def _update_layer(con, layer, gdf, key, info):
+    fid_column = info['fid_column'] or 'fid'
+    geom_column = info['geometry_name'] or 'geom'
+    existing = [row[1] for row in con.execute(f'PRAGMA table_info("{layer}")')]
+    columns = [c for c in gdf.columns if c not in (gdf.geometry.name, fid_column, geom_column)]
+
+    for column in existing:
+        if column not in columns and column not in (fid_column, geom_column, key):
+            con.execute(f'ALTER TABLE "{layer}" DROP COLUMN "{column}"')
+    for column in columns:
+        if column not in existing:
+            con.execute(f'ALTER TABLE "{layer}" ADD COLUMN "{column}" {_sql_type(gdf[column].dtype)}')
+
+    values = [_sql_values(gdf[column]) for column in columns if column != key]
+    assignments = ', '.join(f'"{column}" = ?' for column in columns if column != key)
+    keys = _sql_values(gdf[key])
+    if assignments:
+        con.executemany(f'UPDATE "{layer}" SET {assignments} WHERE "{key}" = ?', zip(*values, keys))
+
+    # Geometrias: só as que mudaram (ex.: corrigidas com buffer(0))
+    stored = dict(con.execute(f'SELECT "{key}", "{geom_column}" FROM "{layer}"'))
+    old = shapely.from_wkb([_gpkg_blob_to_wkb(stored.get(k)) for k in keys])
+    new = gdf.geometry.values
+    changed = np.flatnonzero(~shapely.equals_exact(old, np.asarray(new, dtype=object), tolerance=0)
+                             & ~(shapely.is_missing(old) & shapely.is_missing(new)))
+    if len(changed):
+        srs_id = con.execute('SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?', (layer,)).fetchone()[0]
+        con.executemany(f'UPDATE "{layer}" SET "{geom_column}" = ? WHERE "{key}" = ?',
+                        [(_geometry_to_gpkg_blob(new[i], srs_id), keys[i]) for i in changed])
+        minx, miny, maxx, maxy = gdf.total_bounds
+        con.execute('UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? WHERE table_name = ?',
+                    (minx, miny, maxx, maxy, layer))
+    con.execute("UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE table_name = ?",
+                (layer,))
@@ -0,0 +1,114 @@
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import shapely
+import shutil
+import json
+import os
+from camadas import layer_version
+
+# Réplica colunar (GeoParquet, lida via Arrow) das camadas do GeoPackage.
+# O GPKG continua sendo onde os scripts gravam (transações, upserts por
+# gbifID, atualização de colunas no lugar); as leituras podem vir da réplica,
+# que permite ler só as colunas pedidas e pular grupos de linhas fora do
+# retângulo de interesse. Cada camada vira um diretório de arquivos
+# part-NNNNN.parquet, com as linhas ordenadas pela curva de Hilbert e a
+# coluna 'bbox' de cobertura, usada para descartar grupos de linhas.
+
+# Feições lidas do GPKG por arquivo da réplica e linhas por grupo de linhas
+FEATURES_PER_FILE = 200000
+ROW_GROUP_SIZE = 10000
+
+SOURCE_FILE = '_source.json'
+
+
+def _hilbert_sorted(gdf):
+    valid = ~(gdf.geometry.isna() | gdf.geometry.is_empty).to_numpy()
+    if not valid.any():
+        return gdf
+    distances = np.full(len(gdf), np.iinfo(np.uint32).max, dtype=np.int64)
+    distances[valid] = gdf.geometry[valid].hilbert_distance(total_bounds=gdf.geometry[valid].total_bounds)
+    return gdf.iloc[np.argsort(distances, kind='stable')]
+
+
+class ParquetReplica:
+    """
+    Réplica em `directory` das camadas do GeoPackage `gpkg_path`. Uma camada
+    é (re)publicada na primeira leitura após mudar no GPKG.
+    """
+
+    def __init__(self, gpkg_path, directory=None):
+        self.gpkg_path = gpkg_path
+        self.directory = directory or os.path.join(os.path.dirname(gpkg_path), 'parquet')
+
+    def _layer_dir(self, layer):
+        return os.path.join(self.directory, layer)
+
+    def _source(self, layer):
+        source_path = os.path.join(self._layer_dir(layer), SOURCE_FILE)
+        if not os.path.exists(source_path):
+            return None
+        with open(source_path) as f:
+            return json.load(f)
+
+    def is_current(self, layer):
+        source = self._source(layer)
+        return source is not None and source['version'] == layer_version(self.gpkg_path, layer)
+
+    def publish(self, layer):
+        """
+        Regrava a réplica da camada a partir do GPKG, em lotes de
+        FEATURES_PER_FILE feições (memória limitada). A réplica anterior só é
+        substituída quando a nova está completa.
+        """
+        print(f"Réplica GeoParquet: publicando '{layer}'...")
+        version = layer_version(self.gpkg_path, layer)
+        n_features = pyogrio.read_info(self.gpkg_path, layer=layer)['features']
+        tmp_dir = f'{self._layer_dir(layer)}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        crs, columns = None, None
+        for part, start in enumerate(range(0, max(n_features, 1), FEATURES_PER_FILE)):
+            gdf = gpd.read_file(self.gpkg_path, layer=layer, skip_features=start,
+                                max_features=FEATURES_PER_FILE, fid_as_index=True)
+            crs, columns = gdf.crs, list(gdf.columns)
+            _hilbert_sorted(gdf).to_parquet(os.path.join(tmp_dir, f'part-{part:05d}.parquet'),
+                                            write_covering_bbox=True, row_group_size=ROW_GROUP_SIZE)
+        with open(os.path.join(tmp_dir, SOURCE_FILE), 'w') as f:
+            json.dump({'version': version, 'crs': crs.to_wkt() if crs else None, 'columns': columns}, f)
+
+        final_dir = self._layer_dir(layer)
+        old_dir = f'{final_dir}.{os.getpid()}.old'
+        if os.path.exists(final_dir):
+            os.rename(final_dir, old_dir)
+        os.rename(tmp_dir, final_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def read(self, layer, columns=None, bbox=None, mask=None, fid_as_index=False):
+        """
+        Lê a camada da réplica (publicando-a antes, se estiver desatualizada).
+        `columns` limita as colunas decodificadas (a geometria sempre vem);
+        `bbox` (no CRS da camada) e `mask` (GeoSeries/geometria) descartam
+        grupos de linhas pelas estatísticas da coluna 'bbox' e depois filtram
+        as feições, como o filtro espacial do leitor do GPKG.
+        """
+        if not self.is_current(layer):
+            self.publish(layer)
+        source = self._source(layer)
+        crs = source['crs']
+
+        mask_geom = None
+        if mask is not None:
+            if isinstance(mask, (gpd.GeoSeries, gpd.GeoDataFrame)):
+                mask = mask.to_crs(crs).union_all() if crs and mask.crs else mask.union_all()
+            mask_geom = mask
+            bbox = mask.bounds
+
+        if columns is not None:
+            columns = list(columns) + ['geometry']
+        gdf = gpd.read_parquet(self._layer_dir(layer), columns=columns, bbox=bbox)
+        if bbox is not None:
+            gdf = gdf[gdf.intersects(mask_geom if mask_geom is not None else shapely.box(*bbox))]
+        gdf = gdf[[c for c in source['columns'] if c in gdf.columns]].sort_index()
+        return gdf if fid_as_index else gdf.reset_index(drop=True)
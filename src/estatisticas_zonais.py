@@ -0,0 +1,332 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import hashlib
+import json
+import multiprocessing
+import os
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+
+# Estatísticas zonais lendo de cada raster apenas a janela que cobre cada
+# polígono. A máscara do polígono é rasterizada uma vez por feição e reusada
+# entre rasters de mesma grade. Mesma convenção do rasterstats: entram os
+# pixels cujo centro está dentro do polígono, e nodata é ignorado.
+
+def _grid_key(src):
+    return (src.crs.to_string() if src.crs else None, tuple(src.transform), src.width, src.height)
+
+def _feature_window(src, geom):
+    """Janela do raster que cobre `geom` (None se estiver fora do raster)."""
+    try:
+        window = geometry_window(src, [geom])
+    except WindowError:
+        return None
+    if window.width == 0 or window.height == 0:
+        return None
+    return window
+
+def _feature_mask(src, geom, window):
+    return geometry_mask([geom], out_shape=(int(window.height), int(window.width)),
+                         transform=src.window_transform(window), invert=True)
+
+def _read_feature(src, geom):
+    """
+    Janela do raster que cobre `geom` e a máscara do polígono nessa janela
+    (None se o polígono estiver fora do raster).
+    """
+    window = _feature_window(src, geom)
+    if window is None:
+        return None
+    return window, _feature_mask(src, geom, window)
+
+def _valid_values(src, window, mask):
+    data = src.read(1, window=window, masked=True)
+    valid = mask & ~np.ma.getmaskarray(data)
+    return data.data[valid]
+
+def compute_zonal_stats(gdf, raster_paths, categorical=(), histogram_indexes=None):
+    """
+    Calcula estatísticas zonais das geometrias de `gdf` em cada raster de
+    `raster_paths` ({nome: caminho}); cada raster é aberto uma única vez.
+    Rasters categóricos com índice de histogramas em `histogram_indexes`
+    ({nome: caminho do índice}) são respondidos por TileHistogramIndex.
+
+    Retorna {nome: DataFrame} alinhado ao índice de `gdf`:
+      - rasters contínuos: colunas 'mean', 'min', 'max' e 'count';
+      - rasters em `categorical`: nº de pixels por classe (uma coluna por
+        código de classe, em ordem crescente), via np.bincount.
+    """
+    results = {}
+    indexes = {name: _worker_indexes[path] if path in _worker_indexes else TileHistogramIndex.load(path)
+               for name, path in (histogram_indexes or {}).items()}
+    with ExitStack() as stack:
+        sources = {name: stack.enter_context(rasterio.open(path)) for name, path in raster_paths.items()}
+
+        # Rasters de mesma grade compartilham as geometrias reprojetadas e as máscaras
+        grids = {}
+        for name, src in sources.items():
+            grids.setdefault(_grid_key(src), []).append(name)
+
+        for names in grids.values():
+            crs = sources[names[0]].crs
+            geoms = gdf.geometry.to_crs(crs).values if crs else gdf.geometry.values
+            continuous = {name: np.full((len(gdf), 4), np.nan) for name in names if name not in categorical}
+            histograms = {name: [] for name in names if name in categorical}
+            # Rasters com índice não usam a máscara da janela inteira
+            masked = [name for name in names if name not in indexes]
+
+            for i, geom in enumerate(geoms):
+                feature = None
+                if masked and geom is not None and not geom.is_empty:
+                    feature = _read_feature(sources[masked[0]], geom)
+                for name in names:
+                    if name in indexes:
+                        histograms[name].append(indexes[name].histogram(sources[name], geom))
+                        continue
+                    values = _valid_values(sources[name], *feature) if feature else np.empty(0)
+                    if name in histograms:
+                        histograms[name].append(_histogram(values))
+                    elif values.size:
+                        continuous[name][i] = [values.mean(), values.min(), values.max(), values.size]
+                    else:
+                        continuous[name][i, 3] = 0
+
+            for name, stats in continuous.items():
+                results[name] = pd.DataFrame(stats, index=gdf.index, columns=['mean', 'min', 'max', 'count'])
+            for name, hists in histograms.items():
+                results[name] = _histograms_to_frame(hists, gdf.index)
+    return results
+
+# Índices de histogramas carregados uma única vez em cada processo do pool
+_worker_indexes = {}
+
+def _init_worker(histogram_indexes):
+    for path in histogram_indexes.values():
+        _worker_indexes[path] = TileHistogramIndex.load(path)
+
+def compute_zonal_stats_parallel(gdf, raster_paths, categorical=(), num_workers=None, chunk_size=64,
+                                 histogram_indexes=None):
+    """
+    Versão paralela de compute_zonal_stats. As feições são ordenadas pela
+    curva de Hilbert e divididas em blocos de `chunk_size` espacialmente
+    próximos (janelas vizinhas do raster); cada bloco é processado em um
+    processo que abre os rasters somente para leitura. Os resultados são
+    devolvidos na ordem original de `gdf`.
+
+    Os processos são criados pelo método 'forkserver' (ou 'spawn', onde ele
+    não existe), e não por fork: a função pode ser chamada de uma thread (o
+    registro de indicadores os calcula em paralelo), e um fork de processo com
+    várias threads pode herdar travas do GDAL presas e travar o processo filho.
+    Cada processo carrega os índices de `histogram_indexes` uma vez, ao ser
+    criado, e não a cada bloco.
+    """
+    num_workers = num_workers or os.cpu_count()
+    if num_workers <= 1 or len(gdf) <= chunk_size:
+        return compute_zonal_stats(gdf, raster_paths, categorical, histogram_indexes)
+
+    features = gpd.GeoDataFrame(geometry=gdf.geometry.values, crs=gdf.crs)
+    order = np.argsort(features.geometry.hilbert_distance().to_numpy(), kind='stable')
+    chunks = [features.iloc[order[start:start + chunk_size]] for start in range(0, len(features), chunk_size)]
+
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context(start_method),
+                             initializer=_init_worker, initargs=(histogram_indexes or {},)) as pool:
+        parts = list(pool.map(compute_zonal_stats, chunks, repeat(raster_paths), repeat(tuple(categorical)),
+                              repeat(histogram_indexes)))
+
+    results = {}
+    for name in raster_paths:
+        merged = pd.concat([part[name] for part in parts]).sort_index()
+        if name in categorical:
+            merged = merged.fillna(0).astype(np.int64)
+            merged = merged[sorted(merged.columns)]
+        merged.index = gdf.index
+        results[name] = merged
+    return results
+
+def _histogram(values):
+    """(códigos, contagens) das classes presentes em `values`."""
+    if values.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    codes = values.astype(np.int64)
+    offset = codes.min()
+    if offset < 0 or codes.max() > 65535:
+        return np.unique(codes, return_counts=True)
+    counts = np.bincount(codes)
+    present = np.flatnonzero(counts)
+    return present, counts[present]
+
+def _histograms_to_frame(histograms, index):
+    classes = np.unique(np.concatenate([codes for codes, _ in histograms] + [np.empty(0, dtype=np.int64)]))
+    table = np.zeros((len(histograms), len(classes)), dtype=np.int64)
+    for i, (codes, counts) in enumerate(histograms):
+        table[i, np.searchsorted(classes, codes)] = counts
+    return pd.DataFrame(table, index=index, columns=classes)
+
+def top_two_categories(counts):
+    """
+    Classes majoritária e segunda majoritária de cada linha de uma tabela
+    de contagens por classe (NaN onde não houver). Empates ficam com o
+    menor código.
+    """
+    values = counts.to_numpy()
+    classes = counts.columns.to_numpy(dtype=float)
+    if values.shape[1] == 0:
+        empty = np.full(len(counts), np.nan)
+        return pd.Series(empty, index=counts.index), pd.Series(empty.copy(), index=counts.index)
+    order = np.argsort(-values, axis=1, kind='stable')
+    rows = np.arange(len(values))
+    first = np.where(values[rows, order[:, 0]] > 0, classes[order[:, 0]], np.nan)
+    if values.shape[1] > 1:
+        second = np.where(values[rows, order[:, 1]] > 0, classes[order[:, 1]], np.nan)
+    else:
+        second = np.full(len(values), np.nan)
+    return pd.Series(first, index=counts.index), pd.Series(second, index=counts.index)
+
+def class_fractions(counts):
+    """Fração da área (pixels válidos) de cada classe por feição."""
+    totals = counts.sum(axis=1).replace(0, np.nan)
+    return counts.div(totals, axis=0)
+
+# Índice de histogramas por bloco para rasters categóricos estáticos (MapBiomas)
+
+def raster_checksum(path, chunk_size=8 * 1024 * 1024):
+    """SHA-256 do arquivo do raster."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class TileHistogramIndex:
+    """
+    Histogramas de classes pré-calculados para cada bloco de
+    `tile_size` x `tile_size` pixels de um raster categórico estático.
+    O histograma de um polígono soma os blocos inteiramente cobertos por ele
+    e só faz trabalho por pixel nos blocos da borda, então o custo cresce
+    com o perímetro do polígono e não com a área.
+    """
+
+    def __init__(self, counts, tile_size, metadata):
+        self.counts = counts  # (linhas de blocos, colunas de blocos, códigos de classe)
+        self.tile_size = tile_size
+        self.metadata = metadata
+
+    @classmethod
+    def build(cls, raster_path, tile_size=256):
+        with rasterio.open(raster_path) as src:
+            if not np.issubdtype(np.dtype(src.dtypes[0]), np.integer) or np.dtype(src.dtypes[0]).itemsize > 2:
+                raise ValueError(f"Raster categórico deve ser inteiro de até 16 bits: {raster_path}")
+            n_rows = -(-src.height // tile_size)
+            n_cols = -(-src.width // tile_size)
+            tiles = {}
+            n_bins = 0
+            for tile_row in range(n_rows):
+                for tile_col in range(n_cols):
+                    window = cls._tile_window(src, tile_row, tile_col, tile_size)
+                    data = src.read(1, window=window, masked=True)
+                    values = data.data[~np.ma.getmaskarray(data)].astype(np.int64)
+                    if values.size:
+                        tiles[tile_row, tile_col] = np.bincount(values)
+                        n_bins = max(n_bins, len(tiles[tile_row, tile_col]))
+        counts = np.zeros((n_rows, n_cols, n_bins), dtype=np.uint32)
+        for (tile_row, tile_col), hist in tiles.items():
+            counts[tile_row, tile_col, :len(hist)] = hist
+        stat = os.stat(raster_path)
+        metadata = {
+            'checksum': raster_checksum(raster_path),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+        return cls(counts, tile_size, metadata)
+
+    def save(self, path):
+        np.savez_compressed(path, counts=self.counts, tile_size=self.tile_size,
+                            metadata=json.dumps(self.metadata))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['counts'], int(data['tile_size']), json.loads(str(data['metadata'])))
+
+    @classmethod
+    def load_or_build(cls, raster_path, index_path, tile_size=256):
+        """
+        Carrega o índice de `index_path` ou o (re)constrói. O índice vale
+        enquanto o checksum do raster não mudar; se tamanho e data de
+        modificação forem os mesmos da construção, o checksum nem é refeito.
+        """
+        if os.path.exists(index_path):
+            index = cls.load(index_path)
+            stat = os.stat(raster_path)
+            meta = index.metadata
+            if index.tile_size == tile_size:
+                if (meta['size'], meta['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                    return index
+                if meta['checksum'] == raster_checksum(raster_path):
+                    meta.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                    index.save(index_path)
+                    return index
+            print(f"Índice de histogramas desatualizado: reconstruindo {index_path}")
+        index = cls.build(raster_path, tile_size)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        index.save(index_path)
+        return index
+
+    @staticmethod
+    def _tile_window(src, tile_row, tile_col, tile_size):
+        row_off, col_off = tile_row * tile_size, tile_col * tile_size
+        return Window(col_off, row_off, min(tile_size, src.width - col_off), min(tile_size, src.height - row_off))
+
+    def histogram(self, src, geom):
+        """
+        (códigos, contagens) das classes sob `geom` (no CRS do raster `src`).
+        Os blocos são classificados pela geometria da grade: os que têm todos
+        os centros de pixel dentro do polígono somam o histograma
+        pré-calculado, os sem nenhum centro dentro são ignorados, e só os da
+        borda são lidos e rasterizados, cada um na sua própria janela.
+        """
+        window = None if geom is None or geom.is_empty else _feature_window(src, geom)
+        if window is None:
+            return _histogram(np.empty(0))
+        ts = self.tile_size
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+
+        # Blocos tocados pela janela e o retângulo dos centros de seus pixels
+        tile_rows, tile_cols = np.meshgrid(np.arange(row_start // ts, (row_stop - 1) // ts + 1),
+                                           np.arange(col_start // ts, (col_stop - 1) // ts + 1), indexing='ij')
+        tile_rows, tile_cols = tile_rows.ravel(), tile_cols.ravel()
+        first_row, first_col = tile_rows * ts, tile_cols * ts
+        last_row = np.minimum(first_row + ts, src.height) - 1
+        last_col = np.minimum(first_col + ts, src.width) - 1
+        x0, y0 = src.transform * (first_col + 0.5, first_row + 0.5)
+        x1, y1 = src.transform * (last_col + 0.5, last_row + 0.5)
+        centers = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+        shapely.prepare(geom)
+        full = shapely.contains(geom, centers)
+        boundary = ~full & shapely.intersects(geom, centers)
+
+        counts = self.counts[tile_rows[full], tile_cols[full]].sum(axis=0, dtype=np.int64)
+        for i in np.flatnonzero(boundary):
+            # Parte do bloco dentro da janela do polígono
+            r0, r1 = max(first_row[i], row_start), min(last_row[i] + 1, row_stop)
+            c0, c1 = max(first_col[i], col_start), min(last_col[i] + 1, col_stop)
+            part = Window(c0, r0, c1 - c0, r1 - r0)
+            part_mask = _feature_mask(src, geom, part)
+            if not part_mask.any():
+                continue
+            codes, part_counts = _histogram(_valid_values(src, part, part_mask))
+            if len(codes) and codes[-1] >= len(counts):
+                counts = np.pad(counts, (0, codes[-1] + 1 - len(counts)))
+            counts[codes] += part_counts
+
+        present = np.flatnonzero(counts)
+        return present, counts[present]
@@ -0,0 +1,190 @@
+import requests
+import requests_cache
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Cliente da API de busca de ocorrências do GBIF com paginação completa,
+# requisições concorrentes limitadas e novas tentativas com backoff exponencial.
+
+GBIF_API_URL = 'https://api.gbif.org/v1/occurrence/search'
+
+# A API limita cada página a 300 registros e a paginação a offset + limit <= 100000
+PAGE_SIZE = 300
+MAX_OFFSET = 100000
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def create_cached_session(cache_path, ttl_days=30, offline=False):
+    """
+    Sessão HTTP com cache persistente em SQLite. A chave de cada resposta é
+    a URL com os parâmetros normalizados (classKey, geometria WKT, offset,
+    filtros...). Em modo `offline` só o cache é consultado: requisições sem
+    resposta armazenada retornam 504 sem acessar a rede.
+    """
+    return requests_cache.CachedSession(
+        cache_path,
+        backend='sqlite',
+        expire_after=ttl_days * 24 * 3600,
+        allowable_codes=(200,),
+        stale_if_error=offline,
+        only_if_cached=offline,
+    )
+
+
+def evict_cache(session, max_size_mb):
+    """
+    Remove respostas expiradas e, se o conteúdo do cache ainda exceder
+    `max_size_mb`, as respostas mais antigas (menor data de expiração), só
+    até o total voltar ao limite. O espaço liberado é devolvido ao disco com
+    um único VACUUM no final.
+    """
+    cache = session.cache
+    cache.delete(expired=True, vacuum=False)
+    responses = cache.responses
+    with responses.connection() as con:
+        rows = con.execute(f'SELECT key, LENGTH(value) FROM {responses.table_name} ORDER BY expires').fetchall()
+    excess = sum(size for _, size in rows) - max_size_mb * 1024 * 1024
+    oldest = []
+    for key, size in rows:
+        if excess <= 0:
+            break
+        oldest.append(key)
+        excess -= size
+    if oldest:
+        cache.delete(*oldest, vacuum=False)
+    responses.vacuum()
+
+
+class GbifClient:
+    """
+    Cliente HTTP para /occurrence/search. `base_url` permite apontar para
+    um servidor local que imite a API; `session_factory` cria a sessão HTTP
+    de cada thread (requests.Session por padrão).
+    """
+
+    def __init__(self, base_url=GBIF_API_URL, session_factory=requests.Session, page_size=PAGE_SIZE,
+                 max_retries=5, backoff_base_s=1.0, timeout_s=60):
+        self.base_url = base_url
+        self.session_factory = session_factory
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.timeout_s = timeout_s
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = self.session_factory()
+        return self._local.session
+
+    def _backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff_base_s * (2 ** attempt)
+
+    def get_page(self, params, offset=0):
+        """
+        Busca uma página de resultados. Respostas 429/5xx e erros de conexão
+        são repetidos com backoff exponencial (ou Retry-After) até
+        `max_retries` vezes.
+        """
+        query = dict(params, offset=offset, limit=self.page_size)
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = self.session.get(self.base_url, params=query, timeout=self.timeout_s)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.json()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            if attempt == self.max_retries:
+                response.raise_for_status()
+            time.sleep(self._backoff_delay(attempt, response))
+
+    def iter_pages(self, params):
+        """
+        Percorre todas as páginas de uma consulta, gerando (registros, total)
+        até endOfRecords ou o limite de paginação da API.
+        """
+        offset = 0
+        while True:
+            page = self.get_page(params, offset)
+            records = page.get('results', [])
+            yield records, page.get('count')
+            offset += len(records)
+            if page.get('endOfRecords', True) or not records or offset + self.page_size > MAX_OFFSET:
+                break
+
+
+class PageStream:
+    """
+    Executa as consultas `queries` ({chave: parâmetros}) em paralelo, com no
+    máximo `max_workers` requisições simultâneas, e entrega as páginas à
+    medida que chegam, como pares (chave, registros), na thread que itera.
+    A fila entre as threads é limitada a `max_pending_pages`, então a
+    memória ocupada não depende do total de registros. Ao final, `counts`
+    tem o nº de registros baixados por chave, `pages` o nº de páginas e
+    `failed` as chaves cujas consultas falharam.
+    """
+
+    def __init__(self, client, queries, max_workers=4, max_pending_pages=None):
+        self.client = client
+        self.queries = queries
+        self.max_workers = max_workers
+        self.max_pending_pages = max_pending_pages or 2 * max_workers
+        self.counts = {}
+        self.pages = {}
+        self.failed = set()
+
+    def _worker(self, key, params, pages, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            count = None
+            for records, count in self.client.iter_pages(params):
+                if not put(('page', key, records)):
+                    return
+            put(('done', key, count))
+        except Exception as e:
+            put(('error', key, e))
+
+    def __iter__(self):
+        pages = queue.Queue(maxsize=self.max_pending_pages)
+        stop = threading.Event()
+        pending = len(self.queries)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                for key, params in self.queries.items():
+                    self.counts[key] = 0
+                    self.pages[key] = 0
+                    pool.submit(self._worker, key, params, pages, stop)
+                while pending:
+                    kind, key, payload = pages.get()
+                    if kind == 'page':
+                        self.counts[key] += len(payload)
+                        self.pages[key] += 1
+                        yield key, payload
+                    elif kind == 'done':
+                        pending -= 1
+                        total = payload if payload is not None else self.counts[key]
+                        print(f"{key}: {self.counts[key]} de {total} registros baixados.")
+                    else:
+                        pending -= 1
+                        self.failed.add(key)
+                        print(f"Erro na consulta para {key}: {payload}")
+            finally:
+                stop.set()
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import math
+import numpy as np
+import pandas as pd
+import shapely
+
+# Camadas do mapa do painel em versões simplificadas por faixa de zoom,
+# servidas ao navegador como GeoJSON recortado pela área visível (em vez de
+# embutir a geometria completa na figura). As versões são calculadas uma vez,
+# na carga do painel; cada feição já fica serializada, de modo que uma
+# resposta é só a junção das feições que intersectam o retângulo pedido.
+# As ocorrências (pontos) ficam num índice espacial e são enviadas agregadas
+# em células de uma grade, ou individualmente quando o zoom é grande.
+
+
+def band_for_zoom(zoom_bands, zoom):
+    """Índice da faixa (zoom mínimo, zoom máximo, tolerância) que contém `zoom`."""
+    for band, (min_zoom, max_zoom, _) in enumerate(zoom_bands):
+        if min_zoom <= zoom < max_zoom:
+            return band
+    return len(zoom_bands) - 1
+
+
+def snap_bbox(bbox, zoom):
+    """
+    Expande o retângulo (em graus) até a grade de blocos do nível de zoom, para
+    que visualizações próximas peçam a mesma URL (e reaproveitem o cache HTTP).
+    """
+    step = 360 / 2 ** max(int(math.floor(zoom)), 0)
+    minx, miny, maxx, maxy = bbox
+    return (math.floor(minx / step) * step, math.floor(miny / step) * step,
+            math.ceil(maxx / step) * step, math.ceil(maxy / step) * step)
+
+
+def cell_size_for_zoom(zoom, cell_pixels):
+    """Lado (graus) de uma célula com ~`cell_pixels` pixels de largura no zoom dado."""
+    return cell_pixels * 360 / (256 * 2 ** zoom)
+
+
+def simplify_geometries(geoms, tolerance):
+    """
+    Simplificação que preserva a topologia: se as feições formam uma cobertura
+    válida (sem sobreposição), as bordas compartilhadas são simplificadas uma
+    única vez (sem frestas entre vizinhas); senão, cada feição é simplificada
+    sem perder a validade.
+    """
+    if tolerance == 0:
+        return geoms
+    if shapely.coverage_is_valid(geoms):
+        return shapely.coverage_simplify(geoms, tolerance)
+    return shapely.simplify(geoms, tolerance, preserve_topology=True)
+
+
+class SimplifiedLayer:
+    """
+    Versões de uma camada (em EPSG:4326) para cada faixa de `zoom_bands`
+    (tolerância 0 = geometria original), com índice espacial por faixa.
+    `version` identifica o conteúdo da camada de origem (entra no ETag).
+    """
+
+    def __init__(self, gdf, zoom_bands, properties=(), version=''):
+        self.zoom_bands = zoom_bands
+        self.version = version
+        gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+        geoms = np.asarray(gdf.geometry.array)
+        ids = [json.dumps(i, default=str) for i in gdf.index]
+        props = [json.dumps(p, default=str) for p in gdf[list(properties)].to_dict('records')]
+
+        self.bands = []
+        for _, _, tolerance in zoom_bands:
+            simplified = simplify_geometries(geoms, tolerance)
+            features = [f'{{"type":"Feature","id":{i},"properties":{p},"geometry":{g}}}'
+                        for i, p, g in zip(ids, props, shapely.to_geojson(simplified))]
+            self.bands.append({
+                'tree': shapely.STRtree(simplified),
+                'features': features,
+                'n_vertices': int(shapely.get_num_coordinates(simplified).sum()),
+            })
+
+    def geojson(self, band, bbox=None):
+        """FeatureCollection (texto) da faixa `band`, só com as feições que intersectam `bbox`."""
+        data = self.bands[band]
+        if bbox is None:
+            indices = range(len(data['features']))
+        else:
+            indices = np.sort(data['tree'].query(shapely.box(*bbox), predicate='intersects'))
+        return '{"type":"FeatureCollection","features":[' + ','.join(data['features'][i] for i in indices) + ']}'
+
+    def etag(self, band, bbox=None):
+        return hashlib.sha256(f'{self.version}|{self.zoom_bands[band]}|{bbox}'.encode()).hexdigest()[:32]
+
+
+class OccurrenceIndex:
+    """
+    Índice espacial (STRtree) das ocorrências (pontos em EPSG:4326), com as
+    espécies codificadas como inteiros, para o mapa pedir só os pontos da área
+    visível ou agregá-los em células de uma grade do tamanho do zoom.
+    """
+
+    def __init__(self, gdf, species_column='scientificName'):
+        gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+        self.lon = gdf.geometry.x.to_numpy()
+        self.lat = gdf.geometry.y.to_numpy()
+        self.species_codes, self.species = pd.factorize(gdf[species_column])
+        self.tree = shapely.STRtree(shapely.points(self.lon, self.lat))
+
+    def query(self, bbox=None):
+        """Índices das ocorrências dentro de `bbox` (todas, se None)."""
+        if bbox is None:
+            return np.arange(len(self.lon))
+        return np.sort(self.tree.query(shapely.box(*bbox)))
+
+    def points(self, indices):
+        """Coordenadas e nome da espécie de cada ocorrência de `indices`."""
+        codes = self.species_codes[indices]
+        names = np.where(codes >= 0, np.asarray(self.species, dtype=object)[np.maximum(codes, 0)], None)
+        return pd.DataFrame({'lon': self.lon[indices], 'lat': self.lat[indices], 'scientificName': names})
+
+    def aggregate(self, indices, cell_size):
+        """
+        Agrega as ocorrências de `indices` em células quadradas de `cell_size`
+        graus (grade ancorada em 0, estável ao mover o mapa): centro da célula,
+        nº de registros e nº de espécies distintas.
+        """
+        columns = ['lon', 'lat', 'n_registros', 'riqueza_especies']
+        if len(indices) == 0:
+            return pd.DataFrame(columns=columns)
+        ix = np.floor(self.lon[indices] / cell_size).astype(np.int64)
+        iy = np.floor(self.lat[indices] / cell_size).astype(np.int64)
+        cells, cell_of_point, counts = np.unique(np.stack([ix, iy], axis=1), axis=0,
+                                                 return_inverse=True, return_counts=True)
+        cell_of_point = cell_of_point.ravel()
+        codes = self.species_codes[indices]
+        known = codes >= 0
+        pairs = np.unique(np.stack([cell_of_point[known], codes[known]], axis=1), axis=0)
+        richness = np.bincount(pairs[:, 0], minlength=len(cells))
+        return pd.DataFrame({
+            'lon': (cells[:, 0] + 0.5) * cell_size, 'lat': (cells[:, 1] + 0.5) * cell_size,
+            'n_registros': counts, 'riqueza_especies': richness,
+        }, columns=columns)
@@ -0,0 +1,249 @@
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import functools
+import threading
+import time
+from camadas import layer_version, read_table
+
+# Índice em memória dos indicadores das AEs e ADAs para o painel: as
+# consultas do callback são buscas em dicionário, sem leitura de arquivo.
+# As ocorrências de cada AE/ADA também são indexadas (por data e táxon) para
+# recalcular riqueza e contagens sob os filtros do painel.
+
+
+# Registros sem data válida ficam no fim do trecho de cada feição
+_NO_DATE = np.iinfo(np.int64).max
+
+# Combinações de filtros (período, táxon) com totais guardados por índice
+TOTALS_CACHE_SIZE = 256
+
+
+def event_days(dates):
+    """
+    Dia (desde 1970-01-01) de cada eventDate do GBIF; intervalos 'início/fim'
+    usam o início e datas inválidas ou ausentes viram _NO_DATE.
+    """
+    parsed = pd.to_datetime(dates.astype('string').str.split('/').str[0], errors='coerce', format='ISO8601', utc=True)
+    days = parsed.dt.tz_localize(None).to_numpy(dtype='datetime64[D]').astype(np.int64)
+    return np.where(parsed.isna().to_numpy(), _NO_DATE, days)
+
+
+def _day(date):
+    return np.datetime64(date, 'D').astype(np.int64)
+
+
+def _json_value(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+class _Snapshot:
+    """Estado imutável do índice (trocado por inteiro a cada recarga)."""
+
+    def __init__(self, aes, adas, ae_key, ada_key, parent_key, versions):
+        self.versions = versions
+        self.aes = aes.set_index(ae_key, drop=False).to_dict('index')
+        self.adas = adas.set_index(ada_key, drop=False).to_dict('index')
+        self.parent = dict(zip(adas[ada_key], adas[parent_key])) if parent_key in adas.columns else {}
+        numeric = aes.select_dtypes('number')
+        self.ae_sums = numeric.sum().to_dict()
+        self.ae_counts = numeric.notna().sum().to_dict()
+
+
+class IndicatorLookup:
+    """
+    Tabelas de atributos (sem geometria) das AEs e ADAs, indexadas por id,
+    com o vínculo ADA → AE pai e as somas de cada coluna numérica das AEs,
+    para que a "média das outras AEs" seja calculada em O(1). O índice é
+    recarregado quando as camadas mudam no GeoPackage; a verificação é feita
+    no máximo a cada `check_interval_s` segundos.
+    """
+
+    def __init__(self, gpkg_path, ae_layer='AEs', ada_layer='ADAs', ae_key='aes_id', ada_key='adas_id',
+                 check_interval_s=5.0):
+        self.gpkg_path = gpkg_path
+        self.layers = (ae_layer, ada_layer)
+        self.keys = (ae_key, ada_key)
+        self.check_interval_s = check_interval_s
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._snapshot = None
+        self.refresh(force=True)
+
+    def __getstate__(self):
+        # A trava não é serializável; o índice pode ser guardado no artefato do painel
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+
+    def _versions(self):
+        return [layer_version(self.gpkg_path, layer) for layer in self.layers]
+
+    def refresh(self, force=False):
+        """Recarrega as tabelas se as camadas mudaram (ou se `force`)."""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval_s:
+            return
+        with self._lock:
+            self._checked_at = now
+            versions = self._versions()
+            if not force and self._snapshot is not None and self._snapshot.versions == versions:
+                return
+            aes = read_table(self.gpkg_path, self.layers[0])
+            adas = read_table(self.gpkg_path, self.layers[1])
+            aes = aes if aes is not None else pd.DataFrame(columns=[self.keys[0]])
+            adas = adas if adas is not None else pd.DataFrame(columns=[self.keys[1]])
+            self._snapshot = _Snapshot(aes, adas, self.keys[0], self.keys[1], self.keys[0], versions)
+
+    def table(self, columns, aes_ids=None, adas_ids=None):
+        """
+        Versão compacta do índice para enviar ao navegador (tipos JSON): só as
+        `columns` de cada AE/ADA, o vínculo ADA → AE e as somas/contagens das
+        AEs usadas na média das outras AEs. Com `aes_ids`/`adas_ids`, só
+        essas feições (e as AEs pai das ADAs) entram, por busca em dicionário;
+        as somas continuam valendo para todas as AEs.
+        """
+        self.refresh()
+        snapshot = self._snapshot
+        parent = snapshot.parent
+        if adas_ids is not None:
+            parent = {i: parent[i] for i in adas_ids if i in parent}
+            if aes_ids is not None:
+                aes_ids = list(aes_ids) + list(parent.values())
+
+        def records(rows, ids):
+            selected = rows.items() if ids is None else ((i, rows[i]) for i in dict.fromkeys(ids) if i in rows)
+            return {str(i): {c: _json_value(row.get(c)) for c in columns} for i, row in selected}
+
+        return {
+            'aes': records(snapshot.aes, aes_ids),
+            'adas': records(snapshot.adas, adas_ids),
+            'parent': {str(k): _json_value(v) for k, v in parent.items()},
+            'ae_sums': {c: _json_value(snapshot.ae_sums.get(c)) for c in columns},
+            'ae_counts': {c: _json_value(snapshot.ae_counts.get(c)) for c in columns},
+            'n_aes': len(snapshot.aes),
+        }
+
+
+class OccurrencePeriodIndex:
+    """
+    Ocorrências de cada feição (AE ou ADA) para filtros de período e táxon:
+    as ocorrências de uma feição ocupam um trecho contíguo dos vetores,
+    ordenado por data, com espécie, ordem e família como códigos inteiros. O
+    período é achado por busca binária no trecho; o filtro de táxon e a
+    contagem de espécies distintas são vetorizados.
+    """
+
+    TAXON_LEVELS = ('order', 'family')
+
+    def __init__(self, occurrences, key):
+        feature_codes, self.feature_ids = pd.factorize(occurrences[key].astype(str))
+        days = event_days(occurrences['eventDate'])
+        order = np.lexsort((days, feature_codes))
+        self.days = days[order]
+        self.species = pd.factorize(occurrences['scientificName'])[0][order]
+        self.n_individuals = occurrences['n_individuals'].to_numpy(dtype=float)[order]
+        self.taxa = {}
+        for level in self.TAXON_LEVELS:
+            codes, names = pd.factorize(occurrences[level])
+            self.taxa[level] = (codes[order], pd.Index(names))
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(feature_codes, minlength=len(self.feature_ids)))])
+        self._positions = {feature_id: i for i, feature_id in enumerate(self.feature_ids)}
+        self._row_features = np.repeat(np.arange(len(self.feature_ids)), np.diff(self.offsets))
+        # Linhas ordenadas por feição e espécie: pares distintos ficam adjacentes
+        self._species_order = np.lexsort((self.species, self._row_features))
+        self.totals = functools.lru_cache(maxsize=TOTALS_CACHE_SIZE)(self._totals)
+
+    def __getstate__(self):
+        # O cache LRU não é serializável; o índice é guardado no artefato do painel
+        state = self.__dict__.copy()
+        del state['totals']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.totals = functools.lru_cache(maxsize=TOTALS_CACHE_SIZE)(self._totals)
+
+    @classmethod
+    def from_layers(cls, occurrences, features, key):
+        """Índice das ocorrências dentro de cada feição de `features` (mesmo CRS), identificadas por `key`."""
+        columns = ['scientificName', 'family', 'order', 'eventDate', 'n_individuals']
+        joined = gpd.sjoin(occurrences[columns + ['geometry']], features[[key, 'geometry']],
+                           how='inner', predicate='within')
+        return cls(joined, key)
+
+    def taxon_names(self, level):
+        """Nomes (ordenados) do nível taxonômico presentes nas ocorrências."""
+        return sorted(self.taxa[level][1])
+
+    def date_range(self):
+        """Primeira e última data (datetime64[D]) das ocorrências datadas, ou None."""
+        dated = self.days[self.days != _NO_DATE]
+        if dated.size == 0:
+            return None
+        return dated.min().astype('datetime64[D]'), dated.max().astype('datetime64[D]')
+
+    def _totals(self, start=None, end=None, taxon=None):
+        """
+        Soma de cada indicador de `summary` entre todas as feições, com os
+        mesmos filtros, numa só passada pelos vetores (a riqueza conta pares
+        feição-espécie distintos, já adjacentes em `_species_order`). Exposto
+        como `totals`, com as últimas TOTALS_CACHE_SIZE combinações de
+        filtros em cache LRU.
+        """
+        keep = np.ones(self.days.size, dtype=bool)
+        if start is not None or end is not None:
+            keep &= self.days >= (_day(start) if start is not None else np.iinfo(np.int64).min)
+            keep &= self.days <= (_day(end) if end is not None else _NO_DATE - 1)
+        if taxon is not None:
+            level, name = taxon
+            codes, names = self.taxa[level]
+            code = names.get_indexer([name])[0]
+            keep &= codes == code if code >= 0 else False
+        rows = self._species_order[keep[self._species_order] & (self.species[self._species_order] >= 0)]
+        pairs = self._row_features[rows] * (int(self.species.max(initial=-1)) + 1) + self.species[rows]
+        # Indivíduos truncados por feição, como em summary
+        individuals = np.bincount(self._row_features[keep], weights=np.nan_to_num(self.n_individuals[keep]),
+                                  minlength=len(self.feature_ids))
+        return {
+            'riqueza_especies': int(np.count_nonzero(np.diff(pairs)) + (pairs.size > 0)),
+            'n_registros': int(keep.sum()),
+            'n_individuos': int(individuals.astype(np.int64).sum()),
+        }
+
+    def summary(self, feature_id, start=None, end=None, taxon=None):
+        """
+        Riqueza de espécies, nº de registros e nº de indivíduos da feição entre
+        as datas `start` e `end` (inclusive; None = sem limite; sem nenhum dos
+        dois entram também os registros sem data), só do táxon `taxon`
+        ((nível, nome)), se dado.
+        """
+        position = self._positions.get(str(feature_id))
+        if position is None:
+            return {'riqueza_especies': 0, 'n_registros': 0, 'n_individuos': 0}
+        lo, hi = self.offsets[position], self.offsets[position + 1]
+        if start is not None or end is not None:
+            days = self.days[lo:hi]
+            first = np.searchsorted(days, _day(start) if start is not None else np.iinfo(np.int64).min, 'left')
+            last = np.searchsorted(days, _day(end) if end is not None else _NO_DATE - 1, 'right')
+            lo, hi = lo + first, lo + last
+        species = self.species[lo:hi]
+        individuals = self.n_individuals[lo:hi]
+        if taxon is not None:
+            level, name = taxon
+            codes, names = self.taxa[level]
+            code = names.get_indexer([name])[0]
+            keep = codes[lo:hi] == code if code >= 0 else np.zeros(hi - lo, dtype=bool)
+            species, individuals = species[keep], individuals[keep]
+        return {
+            'riqueza_especies': int(np.unique(species[species >= 0]).size),
+            'n_registros': int(species.size),
+            'n_individuos': int(np.nansum(individuals)),
+        }
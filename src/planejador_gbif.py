@@ -0,0 +1,63 @@
+import numpy as np
+import shapely
+
+# Planejamento das consultas ao GBIF: AEs próximas são agrupadas em
+# retângulos (blocos) consultados uma única vez, e os pontos retornados são
+# atribuídos localmente a cada AE.
+
+def plan_tiles(geometries, max_tile_size, max_overhead):
+    """
+    Agrupa as geometrias em blocos retangulares. Cada geometria entra no
+    bloco existente cujo retângulo envolvente cresce menos ao recebê-la,
+    desde que o novo retângulo tenha lado de no máximo `max_tile_size` e
+    área de no máximo `max_overhead` vezes a soma das áreas dos envelopes
+    das geometrias do bloco; caso contrário, abre um novo bloco. As
+    geometrias são percorridas da esquerda para a direita.
+    Retorna uma lista de (retângulo, índices das geometrias).
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    bounds = shapely.bounds(geometries)
+    areas = shapely.area(shapely.envelope(geometries))
+    tiles = []  # [minx, miny, maxx, maxy, soma das áreas, membros]
+
+    for i in np.argsort(bounds[:, 0], kind='stable'):
+        minx, miny, maxx, maxy = bounds[i]
+        best, best_growth = None, None
+        for tile in tiles:
+            tminx, tminy = min(tile[0], minx), min(tile[1], miny)
+            tmaxx, tmaxy = max(tile[2], maxx), max(tile[3], maxy)
+            if max(tmaxx - tminx, tmaxy - tminy) > max_tile_size:
+                continue
+            merged_area = (tmaxx - tminx) * (tmaxy - tminy)
+            if merged_area > max_overhead * (tile[4] + areas[i]):
+                continue
+            growth = merged_area - (tile[2] - tile[0]) * (tile[3] - tile[1])
+            if best is None or growth < best_growth:
+                best, best_growth = tile, growth
+        if best is None:
+            tiles.append([minx, miny, maxx, maxy, areas[i], [i]])
+        else:
+            best[0], best[1] = min(best[0], minx), min(best[1], miny)
+            best[2], best[3] = max(best[2], maxx), max(best[3], maxy)
+            best[4] += areas[i]
+            best[5].append(i)
+
+    return [(shapely.box(*tile[:4]), sorted(tile[5])) for tile in tiles]
+
+
+def assign_points(lon, lat, index):
+    """
+    Índice da geometria de `index` (FeatureIndex) que contém cada ponto
+    (-1 se nenhuma), com uma única consulta vetorizada ao STRtree. Se um
+    ponto cair em mais de uma geometria, fica com a de menor índice.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    assigned = np.full(len(lon), -1, dtype=np.int64)
+    valid = np.flatnonzero(~(np.isnan(lon) | np.isnan(lat)))
+    if len(valid) == 0:
+        return assigned
+    point_idx, geom_idx = index.tree.query(shapely.points(lon[valid], lat[valid]), predicate='intersects')
+    order = np.lexsort((geom_idx, point_idx))[::-1]
+    assigned[valid[point_idx[order]]] = geom_idx[order]
+    return assigned
@@ -0,0 +1,165 @@
+import pandas as pd
+import shapely
+import hashlib
+import json
+import threading
+import os
+from concurrent.futures import ThreadPoolExecutor
+from estatisticas_zonais import raster_checksum
+
+# Registro de indicadores com recálculo incremental. Cada indicador declara
+# as entradas de que depende (camadas, rasters) e seus parâmetros; os
+# resultados ficam guardados por feição, endereçados pelo hash da geometria,
+# e só são recalculados para feições novas/alteradas ou quando a impressão
+# digital do indicador (entradas + parâmetros + versão) muda.
+
+
+def geometry_hashes(geometries):
+    """SHA-256 (hex) do WKB de cada geometria."""
+    return pd.Index([hashlib.sha256(wkb).hexdigest() for wkb in shapely.to_wkb(geometries.values)])
+
+
+class Indicator:
+    def __init__(self, name, compute, inputs=(), params=None, version=1):
+        self.name = name
+        self.compute = compute
+        self.inputs = tuple(inputs)
+        self.params = params or {}
+        self.version = version
+
+
+class IndicatorInputs:
+    """
+    Entradas dos indicadores, carregadas sob demanda e uma única vez (mesmo
+    com indicadores rodando em threads). Cada entrada tem um carregador e
+    uma função que devolve sua impressão digital (checksum da origem).
+    """
+
+    def __init__(self):
+        self._sources = {}
+        self._values = {}
+        self._fingerprints = {}
+        self._locks = {}
+
+    def add(self, name, loader, fingerprint):
+        self._sources[name] = (loader, fingerprint)
+        self._locks[name] = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._sources
+
+    def get(self, name):
+        with self._locks[name]:
+            if name not in self._values:
+                self._values[name] = self._sources[name][0]()
+            return self._values[name]
+
+    def fingerprint(self, name):
+        with self._locks[name]:
+            if name not in self._fingerprints:
+                self._fingerprints[name] = self._sources[name][1]()
+            return self._fingerprints[name]
+
+
+class IndicatorStore:
+    """
+    Resultados por indicador em `directory`: um DataFrame (pickle) indexado
+    pelo hash da geometria, com a impressão digital do indicador que o gerou.
+    Também memoriza checksums de arquivos por (tamanho, data de modificação).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._checksum_lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.pkl')
+
+    def load(self, name, fingerprint):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        stored = pd.read_pickle(path)
+        return stored['values'] if stored['fingerprint'] == fingerprint else None
+
+    def save(self, name, fingerprint, values):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self._path(name)}.{os.getpid()}.tmp'
+        pd.to_pickle({'fingerprint': fingerprint, 'values': values}, tmp_path)
+        os.replace(tmp_path, self._path(name))
+
+    def file_checksum(self, path):
+        """Checksum de um arquivo, recalculado só se tamanho ou data mudarem."""
+        memo_path = os.path.join(self.directory, 'checksums.json')
+        with self._checksum_lock:
+            memo = {}
+            if os.path.exists(memo_path):
+                with open(memo_path) as f:
+                    memo = json.load(f)
+            stat = os.stat(path)
+            entry = memo.get(os.path.abspath(path))
+            if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+                return entry[2]
+            checksum = raster_checksum(path)
+            memo[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, checksum]
+            os.makedirs(self.directory, exist_ok=True)
+            with open(memo_path, 'w') as f:
+                json.dump(memo, f)
+            return checksum
+
+
+class IndicatorRegistry:
+    def __init__(self):
+        self.indicators = {}
+
+    def register(self, name, inputs=(), params=None, version=1):
+        """
+        Decorador que registra `compute(features, inputs, **params)`, que
+        recebe as feições a calcular e devolve um DataFrame com o mesmo índice.
+        """
+        def decorator(compute):
+            self.indicators[name] = Indicator(name, compute, inputs, params, version)
+            return compute
+        return decorator
+
+    def fingerprint(self, indicator, inputs):
+        parts = {
+            'name': indicator.name,
+            'version': indicator.version,
+            'params': indicator.params,
+            'inputs': {name: inputs.fingerprint(name) for name in indicator.inputs},
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _run_one(self, indicator, features, keys, inputs, store):
+        fingerprint = self.fingerprint(indicator, inputs)
+        cached = store.load(indicator.name, fingerprint)
+        if cached is None:
+            cached = pd.DataFrame(index=pd.Index([], dtype=object))
+        missing = ~keys.isin(cached.index)
+
+        parts = [cached[cached.index.isin(keys)]]
+        if missing.any():
+            computed = indicator.compute(features[missing], inputs, **indicator.params)
+            computed.index = keys[missing]
+            parts.append(computed)
+        values = pd.concat(parts)
+        values = values[~values.index.duplicated(keep='last')]
+        store.save(indicator.name, fingerprint, values)
+        print(f"Indicador '{indicator.name}': {int(missing.sum())} de {len(keys)} feições calculadas.")
+        return values.reindex(keys)
+
+    def run(self, features, inputs, store, names=None, max_workers=None):
+        """
+        Calcula os indicadores `names` (todos, por padrão) para `features`,
+        reaproveitando os resultados guardados em `store`. Indicadores
+        independentes rodam em paralelo em threads. Retorna um DataFrame com
+        as colunas de todos os indicadores, alinhado ao índice de `features`.
+        """
+        indicators = [self.indicators[name] for name in (names or self.indicators)]
+        keys = geometry_hashes(features.geometry)
+        with ThreadPoolExecutor(max_workers=max_workers or len(indicators) or 1) as pool:
+            results = list(pool.map(lambda ind: self._run_one(ind, features, keys, inputs, store), indicators))
+        table = pd.concat(results, axis=1) if results else pd.DataFrame(index=keys)
+        table.index = features.index
+        return table
@@ -0,0 +1,183 @@
+import numpy as np
+import shapely
+import math
+
+# Verificações de restrições espaciais sobre feições individuais, usando
+# índices espaciais em vez de dissolver (union_all) camadas inteiras do estado.
+
+def union_by_group(geometries, groups, n_groups):
+    """
+    Une as geometrias por grupo (inteiros em [0, n_groups)). Retorna um
+    array de tamanho n_groups, com None nos grupos sem geometrias.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    result = np.full(n_groups, None, dtype=object)
+    if len(geometries) == 0:
+        return result
+    order = np.argsort(groups, kind='stable')
+    groups, geometries = np.asarray(groups)[order], geometries[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(groups)]):
+        result[groups[start]] = shapely.union_all(geometries[start:end])
+    return result
+
+
+class FeatureIndex:
+    """
+    Índice espacial (STRtree) sobre as feições individuais de uma camada.
+    Todas as consultas recebem um array de geometrias e respondem de forma
+    vetorizada, na mesma ordem da entrada.
+    """
+
+    def __init__(self, geometries):
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def from_gdf(cls, gdf):
+        return cls(gdf.geometry.values)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def _hits(self, geoms, predicate, distance=None):
+        geoms = np.atleast_1d(np.asarray(geoms, dtype=object))
+        if distance is None:
+            pairs = self.tree.query(geoms, predicate=predicate)
+        else:
+            pairs = self.tree.query(geoms, predicate=predicate, distance=distance)
+        return geoms, pairs
+
+    def intersects_any(self, geoms):
+        """Máscara: a geometria intersecta alguma feição da camada."""
+        geoms, pairs = self._hits(geoms, 'intersects')
+        mask = np.zeros(len(geoms), dtype=bool)
+        mask[pairs[0]] = True
+        return mask
+
+    def dwithin_any(self, geoms, distance):
+        """Máscara: a geometria está a até `distance` de alguma feição."""
+        geoms, pairs = self._hits(geoms, 'dwithin', distance)
+        mask = np.zeros(len(geoms), dtype=bool)
+        mask[pairs[0]] = True
+        return mask
+
+    def nearest(self, geoms):
+        """
+        Índice da feição mais próxima e a distância até ela para cada
+        geometria (-1 e NaN para geometrias vazias ou índice vazio).
+        """
+        geoms = np.atleast_1d(np.asarray(geoms, dtype=object))
+        indices = np.full(len(geoms), -1, dtype=np.int64)
+        distances = np.full(len(geoms), np.nan)
+        if len(self) == 0:
+            return indices, distances
+        pairs, dist = self.tree.query_nearest(geoms, return_distance=True, all_matches=False)
+        indices[pairs[0]] = pairs[1]
+        distances[pairs[0]] = dist
+        return indices, distances
+
+    def proximity(self, geoms, radii):
+        """
+        Feição mais próxima, distância até ela e nº de feições a até cada
+        raio de `radii`, com uma única consulta 'dwithin' no maior raio. Os
+        pares encontrados são ordenados por geometria e distância: o primeiro
+        de cada geometria é o mais próximo (empate: menor índice) e as
+        contagens por raio saem dos mesmos pares. Só as geometrias sem
+        feição até o maior raio fazem a consulta query_nearest.
+        Retorna (índices, distâncias, contagens[n_geoms, n_raios]).
+        """
+        geoms = np.atleast_1d(np.asarray(geoms, dtype=object))
+        radii = np.asarray(radii, dtype=float)
+        indices = np.full(len(geoms), -1, dtype=np.int64)
+        distances = np.full(len(geoms), np.nan)
+        counts = np.zeros((len(geoms), len(radii)), dtype=np.int64)
+        if len(self) == 0 or len(geoms) == 0:
+            return indices, distances, counts
+
+        if len(radii):
+            pairs = self.tree.query(geoms, predicate='dwithin', distance=radii.max())
+            dist = shapely.distance(geoms[pairs[0]], self.geometries[pairs[1]])
+            order = np.lexsort((pairs[1], dist, pairs[0]))
+            input_idx, tree_idx, dist = pairs[0][order], pairs[1][order], dist[order]
+            first = np.flatnonzero(np.r_[True, input_idx[1:] != input_idx[:-1]]) if len(input_idx) else []
+            indices[input_idx[first]] = tree_idx[first]
+            distances[input_idx[first]] = dist[first]
+            for j, radius in enumerate(radii):
+                counts[:, j] = np.bincount(input_idx[dist <= radius], minlength=len(geoms))
+
+        missing = np.flatnonzero(indices < 0)
+        if len(missing):
+            indices[missing], distances[missing] = self.nearest(geoms[missing])
+        return indices, distances, counts
+
+    def local_unions(self, geoms):
+        """
+        Para cada geometria, a união apenas das feições que a intersectam
+        (None se nenhuma).
+        """
+        geoms, pairs = self._hits(geoms, 'intersects')
+        return union_by_group(self.geometries[pairs[1]], pairs[0], len(geoms))
+
+    def within_union(self, geoms):
+        """
+        Máscara: a geometria está contida na união das feições. Só as
+        feições que a intersectam são unidas, uma geometria por vez, e
+        apenas quando ela não está contida em uma única feição.
+        """
+        geoms, pairs = self._hits(geoms, 'intersects')
+        mask = np.zeros(len(geoms), dtype=bool)
+        if pairs.shape[1] == 0:
+            return mask
+        _, within_pairs = self._hits(geoms, 'within')
+        mask[within_pairs[0]] = True
+
+        order = np.argsort(pairs[0], kind='stable')
+        input_idx, tree_idx = pairs[0][order], pairs[1][order]
+        starts = np.flatnonzero(np.r_[True, input_idx[1:] != input_idx[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(input_idx)]):
+            i = input_idx[start]
+            if mask[i] or end - start < 2:
+                continue
+            mask[i] = geoms[i].within(shapely.union_all(self.geometries[tree_idx[start:end]]))
+        return mask
+
+
+class GridIndex:
+    """
+    Índice em grade uniforme que aceita inserções incrementais, para
+    verificar sobreposição com as geometrias já aceitas sem varrer a lista.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.geometries = []
+
+    def _cell_keys(self, geom):
+        minx, miny, maxx, maxy = geom.bounds
+        cs = self.cell_size
+        for i in range(math.floor(minx / cs), math.floor(maxx / cs) + 1):
+            for j in range(math.floor(miny / cs), math.floor(maxy / cs) + 1):
+                yield (i, j)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def insert(self, geom):
+        idx = len(self.geometries)
+        self.geometries.append(geom)
+        for key in self._cell_keys(geom):
+            self.cells.setdefault(key, []).append(idx)
+
+    def intersects_any(self, geom):
+        """A geometria intersecta alguma geometria já inserida."""
+        seen = set()
+        for key in self._cell_keys(geom):
+            for idx in self.cells.get(key, ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                if geom.intersects(self.geometries[idx]):
+                    return True
+        return False
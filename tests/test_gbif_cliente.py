@@ -0,0 +1,97 @@
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from gbif_cliente import GbifClient, PageStream
+
+# Servidor local que imita /occurrence/search: o parâmetro `q` escolhe o
+# comportamento de cada consulta.
+TOTAL_RECORDS = 700
+
+
+class FakeGbifHandler(BaseHTTPRequestHandler):
+    attempts = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        q = params['q']
+        offset, limit = int(params['offset']), int(params['limit'])
+        with self.lock:
+            attempt = self.attempts[(q, offset)] = self.attempts.get((q, offset), 0) + 1
+
+        if q == 'quebrada':
+            return self._send(503, {})
+        if q == 'limitada' and offset == limit and attempt == 1:
+            return self._send(429, {}, {'Retry-After': '0'})
+
+        end = min(offset + limit, TOTAL_RECORDS)
+        results = [{'key': i, 'q': q} for i in range(offset, end)]
+        self._send(200, {'count': TOTAL_RECORDS, 'results': results, 'endOfRecords': end >= TOTAL_RECORDS})
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class PageStreamTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGbifHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.client = GbifClient(base_url=f'http://127.0.0.1:{cls.server.server_port}/',
+                                page_size=300, max_retries=2, backoff_base_s=0, timeout_s=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeGbifHandler.attempts.clear()
+
+    def run_stream(self, keys):
+        stream = PageStream(self.client, {key: {'q': key} for key in keys}, max_workers=2)
+        records = {key: [] for key in keys}
+        for key, page in stream:
+            records[key].extend(r['key'] for r in page)
+        return stream, records
+
+    def test_downloads_every_page(self):
+        stream, records = self.run_stream(['completa'])
+        self.assertEqual(records['completa'], list(range(TOTAL_RECORDS)))
+        self.assertEqual(stream.counts['completa'], TOTAL_RECORDS)
+        self.assertEqual(stream.pages['completa'], 3)
+        self.assertFalse(stream.failed)
+
+    def test_retries_429_with_retry_after(self):
+        stream, records = self.run_stream(['limitada'])
+        self.assertEqual(records['limitada'], list(range(TOTAL_RECORDS)))
+        self.assertEqual(FakeGbifHandler.attempts[('limitada', 300)], 2)
+        self.assertFalse(stream.failed)
+
+    def test_persistent_5xx_fails_only_its_query(self):
+        stream, records = self.run_stream(['quebrada', 'completa'])
+        self.assertEqual(stream.failed, {'quebrada'})
+        self.assertEqual(FakeGbifHandler.attempts[('quebrada', 0)], self.client.max_retries + 1)
+        self.assertEqual(records['completa'], list(range(TOTAL_RECORDS)))
+        self.assertEqual(records['quebrada'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()